@@ -0,0 +1,88 @@
+"""Benchmark the download write path and file copies.
+
+Compares the old way of writing downloads (one aiofiles write per 8 KB
+network chunk) with BufferedFileWriter, and a Python read/write copy with
+copy_file. Reports throughput and CPU seconds per GB for each.
+
+    python bench_io.py --size-mb 2048 --dir downloads
+"""
+import argparse
+import asyncio
+import os
+import time
+
+import aiofiles
+
+from uploader import BufferedFileWriter, copy_file, preallocate
+
+NETWORK_CHUNK = 8192
+
+def chunks(total_size, chunk_size):
+    """Yield total_size bytes in chunk_size pieces, cut from one random buffer"""
+    pool = os.urandom(1024 * 1024)
+    for offset in range(0, total_size, chunk_size):
+        start = offset % len(pool)
+        size = min(chunk_size, total_size - offset, len(pool) - start)
+        yield pool[start:start + size]
+
+async def write_aiofiles(path, total_size, chunk_size):
+    async with aiofiles.open(path, 'wb') as file:
+        for chunk in chunks(total_size, chunk_size):
+            await file.write(chunk)
+
+async def write_buffered(path, total_size, chunk_size, buffer_size):
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+    try:
+        preallocate(fd, total_size)
+        writer = BufferedFileWriter(fd, 0, buffer_size)
+        for chunk in chunks(total_size, chunk_size):
+            await writer.write(chunk)
+        await writer.flush()
+    finally:
+        os.close(fd)
+
+def copy_python(source_path, target_path):
+    with open(source_path, 'rb') as source, open(target_path, 'wb') as target:
+        while True:
+            chunk = source.read(NETWORK_CHUNK)
+            if not chunk:
+                break
+            target.write(chunk)
+
+def measure(name, total_size, run):
+    """Run once and print MB/s and CPU seconds per GB; process_time includes worker threads"""
+    wall, cpu = time.perf_counter(), time.process_time()
+    run()
+    wall, cpu = time.perf_counter() - wall, time.process_time() - cpu
+    gigabytes = total_size / 1024 ** 3
+    print(f"{name:<32} {total_size / wall / 1024 ** 2:9.1f} MB/s {cpu / gigabytes:8.2f} CPU s/GB")
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--size-mb", type=int, default=1024, help="bytes written per run, in MB")
+    parser.add_argument("--buffer-mb", type=int, default=4, help="BufferedFileWriter block size")
+    parser.add_argument("--chunk-kb", type=int, default=64, help="network read size for the new path")
+    parser.add_argument("--dir", default="downloads", help="where to write the test files")
+    args = parser.parse_args()
+
+    os.makedirs(args.dir, exist_ok=True)
+    total_size = args.size_mb * 1024 * 1024
+    source_path = os.path.join(args.dir, "bench_source.bin")
+    target_path = os.path.join(args.dir, "bench_target.bin")
+
+    try:
+        measure("aiofiles, 8 KB writes", total_size,
+                lambda: asyncio.run(write_aiofiles(source_path, total_size, NETWORK_CHUNK)))
+        measure("buffered, 8 KB chunks", total_size,
+                lambda: asyncio.run(write_buffered(source_path, total_size, NETWORK_CHUNK, args.buffer_mb * 1024 * 1024)))
+        measure(f"buffered, {args.chunk_kb} KB chunks", total_size,
+                lambda: asyncio.run(write_buffered(source_path, total_size, args.chunk_kb * 1024, args.buffer_mb * 1024 * 1024)))
+        measure("copy, 8 KB read/write", total_size, lambda: copy_python(source_path, target_path))
+        measure("copy, copy_file_range", total_size, lambda: copy_file(source_path, target_path))
+    finally:
+        for path in (source_path, target_path):
+            if os.path.exists(path):
+                os.remove(path)
+
+if __name__ == "__main__":
+    main()
@@ -1,14 +1,27 @@
 import json
 import asyncio
+import errno
+import io
 import os
 import aiohttp
 import aiofiles
-from pyrogram import Client
-from pymongo import MongoClient
-from datetime import datetime
+import hashlib
+from hashlib import md5
+from pyrogram import Client, raw, types, utils
+from pyrogram.errors import FloodWait, FilePartMissing
+from pyrogram.session import Session
+from pymongo import MongoClient, ReturnDocument, UpdateOne
+from pymongo.errors import DuplicateKeyError, OperationFailure
+from datetime import datetime, timedelta, timezone
+from urllib.parse import urlsplit, urlunsplit, parse_qsl, urlencode
 import logging
 import math
 import re
+import shutil
+import socket
+import time
+import functools
+from concurrent.futures import ThreadPoolExecutor
 
 # Configure logging
 logging.basicConfig(
@@ -21,19 +34,759 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+# Telegram accepts uploads in 512 KB parts; files above 10 MB go through the "big file" API
+TELEGRAM_PART_SIZE = 512 * 1024
+TELEGRAM_BIG_FILE_THRESHOLD = 10 * 1024 * 1024
+
+# Partial downloads save their progress every few seconds, and to MongoDB every few saves
+STATE_SAVE_INTERVAL = 5
+STATE_DB_SAVE_EVERY = 6
+
+# Downloads read up to this much per network read and write to disk in blocks of write_buffer_mb
+READ_CHUNK_SIZE = 64 * 1024
+
+# Catalog IDs are checked against MongoDB in $in batches of this size
+UPLOADED_ID_BATCH = 5000
+
+# The catalog is downloaded and parsed in chunks of this size, and filtered in batches of this many entries
+CATALOG_CHUNK_SIZE = 1024 * 1024
+CATALOG_BATCH = 500
+
+# Returned by download_json_from_gdrive when the catalog hasn't changed since the last sync
+CATALOG_NOT_MODIFIED = "not-modified"
+
+# HEAD answers that mean the link is gone for good, not worth a download attempt
+DEAD_LINK_STATUSES = {404, 410, 451}
+
+# HEAD answers from servers that only serve GET; those are probed with a one-byte range request instead
+HEAD_UNSUPPORTED_STATUSES = {403, 405, 501}
+
+# Query parameters that don't change what a URL points to
+TRACKING_PARAMS = ("utm_", "fbclid", "gclid")
+
+# A single send is retried after this many FloodWait errors at most
+MAX_FLOOD_WAITS = 5
+
+# A send is given up after Telegram reports chunks of its file missing this many times
+MAX_PART_RESAVES = 5
+
+# Attempts per upload part before the movie's upload is given up
+PART_UPLOAD_ATTEMPTS = 3
+
+# Failure classes recorded with failed movies; everything but permanent HTTP errors is retried later
+FAILURE_PERMANENT_HTTP = "permanent_http"
+FAILURE_TRANSIENT_NETWORK = "transient_network"
+FAILURE_TELEGRAM_FLOOD = "telegram_flood"
+FAILURE_DISK = "disk"
+FAILURE_UNKNOWN = "unknown"
+RETRYABLE_FAILURES = {FAILURE_TRANSIENT_NETWORK, FAILURE_TELEGRAM_FLOOD, FAILURE_DISK, FAILURE_UNKNOWN}
+
+# HTTP 4xx answers that are still worth retrying
+TRANSIENT_HTTP_STATUSES = {408, 425, 429}
+
+# Per-movie throughput assumed by time-budget runs until real transfers have been measured
+INITIAL_DOWNLOAD_RATE = 10 * 1024 * 1024
+INITIAL_UPLOAD_RATE = 5 * 1024 * 1024
+
+# Time-budget runs probe and reorder the catalog in windows of this many entries
+SCHEDULE_WINDOW = 200
+
+class HTTPStatusError(Exception):
+    """A download URL answered with an unexpected HTTP status"""
+    def __init__(self, status):
+        super().__init__(f"HTTP {status}")
+        self.status = status
+
+class DownloadStalled(IOError):
+    """Raised when a download goes idle or drops below the minimum rate"""
+
+class RangesNotSupported(Exception):
+    """Raised when a server ignores Range requests, so a single stream must be used"""
+
+class SizeChanged(IOError):
+    """The file behind a link is larger than its probe said"""
+
+class FileSlice(io.RawIOBase):
+    """Read-only file-like window over a byte range of a file.
+    
+    Lets Pyrogram upload one part of a large movie straight from the original
+    file instead of copying the part out to disk first.
+    """
+    
+    def __init__(self, path, offset, length, name=None):
+        super().__init__()
+        self._file = open(path, 'rb')
+        self.offset = offset
+        self.length = length
+        self.name = name or os.path.basename(path)
+        self._position = 0
+    
+    def readable(self):
+        return True
+    
+    def seekable(self):
+        return True
+    
+    def tell(self):
+        return self._position
+    
+    def seek(self, position, whence=os.SEEK_SET):
+        if whence == os.SEEK_CUR:
+            position += self._position
+        elif whence == os.SEEK_END:
+            position += self.length
+        self._position = max(0, min(position, self.length))
+        return self._position
+    
+    def readinto(self, buffer):
+        size = min(len(buffer), self.length - self._position)
+        if size <= 0:
+            return 0
+        data = os.pread(self._file.fileno(), size, self.offset + self._position)
+        buffer[:len(data)] = data
+        self._position += len(data)
+        return len(data)
+    
+    def close(self):
+        if not self.closed:
+            self._file.close()
+        super().close()
+
+class MemoryPart:
+    """A small movie held in memory, uploaded without touching the disk.
+    
+    `name` is the path it would have had on disk, for naming the upload;
+    `reserved` is what it holds of the memory budget.
+    """
+    
+    def __init__(self, name, data, reserved):
+        self.name = name
+        self.data = data
+        self.reserved = reserved
+    
+    def open(self):
+        return io.BytesIO(self.data)
+
+class MemoryBudget:
+    """Bytes of small movies that may be held in memory at once"""
+    
+    def __init__(self, limit):
+        self.limit = limit
+        self.used = 0
+    
+    def try_reserve(self, size):
+        if self.used + size > self.limit:
+            return False
+        self.used += size
+        return True
+    
+    def release(self, size):
+        self.used = max(0, self.used - size)
+
+def preallocate(fd, size):
+    """Reserve size bytes for a file up front, falling back to a sparse file where fallocate isn't supported"""
+    try:
+        os.posix_fallocate(fd, 0, size)
+    except OSError as e:
+        if e.errno not in (errno.EOPNOTSUPP, errno.EINVAL):
+            raise
+        os.ftruncate(fd, size)
+
+def copy_file(source_path, target_path):
+    """Copy a file inside the kernel with copy_file_range, without passing the bytes through Python"""
+    with open(source_path, 'rb') as source, open(target_path, 'wb') as target:
+        size = os.fstat(source.fileno()).st_size
+        offset = 0
+        try:
+            while offset < size:
+                copied = os.copy_file_range(source.fileno(), target.fileno(), size - offset, offset, offset)
+                if copied == 0:
+                    break  # Some kernels give up across filesystems this way instead of with an error
+                offset += copied
+            if offset == size:
+                return
+        except (AttributeError, OSError):
+            pass  # Not Linux, or these filesystems can't copy between each other
+    
+    # shutil uses sendfile where it can
+    shutil.copyfile(source_path, target_path)
+
+def move_file(source_path, target_path):
+    """Rename a file, copying it when the target is on another filesystem"""
+    try:
+        os.replace(source_path, target_path)
+    except OSError as e:
+        if e.errno != errno.EXDEV:
+            raise
+        temp_path = f"{target_path}.tmp"
+        copy_file(source_path, temp_path)
+        os.replace(temp_path, target_path)
+        os.remove(source_path)
+
+class BufferedFileWriter:
+    """Collects network chunks and writes them at a file offset in large blocks.
+    
+    Each block is one os.pwrite on a worker thread, instead of a thread
+    round trip per network chunk. `written` counts only bytes handed to the
+    OS, so saved download progress never runs ahead of the file.
+    """
+    
+    def __init__(self, fd, offset, buffer_size):
+        self.fd = fd
+        self.offset = offset
+        self.buffer_size = buffer_size
+        self.buffer = bytearray()
+        self.written = 0
+    
+    async def write(self, chunk):
+        self.buffer += chunk
+        if len(self.buffer) >= self.buffer_size:
+            await self.flush()
+    
+    async def flush(self):
+        if not self.buffer:
+            return
+        data, self.buffer = self.buffer, bytearray()
+        await asyncio.get_running_loop().run_in_executor(None, self.pwrite_all, self.fd, data, self.offset)
+        self.offset += len(data)
+        self.written += len(data)
+    
+    @staticmethod
+    def pwrite_all(fd, data, offset):
+        view = memoryview(data)
+        while view:
+            written = os.pwrite(fd, view, offset)
+            view = view[written:]
+            offset += written
+
+class StallMonitor:
+    """Throughput floor for one transfer, checked over consecutive windows of `window` seconds"""
+    
+    def __init__(self, min_rate, window):
+        self.min_rate = min_rate
+        self.window = window
+        self.window_start = time.monotonic()
+        self.window_bytes = 0
+    
+    def update(self, size):
+        self.window_bytes += size
+        elapsed = time.monotonic() - self.window_start
+        if elapsed >= self.window:
+            rate = self.window_bytes / elapsed
+            if rate < self.min_rate:
+                raise DownloadStalled(f"{rate / 1024:.1f} KB/s over the last {elapsed:.0f}s")
+            self.window_start += elapsed
+            self.window_bytes = 0
+    
+    def exclude(self, seconds):
+        """Leave out time the transfer spent waiting on us rather than on the network"""
+        self.window_start += seconds
+
+class DiskBudget:
+    """Admission control that reserves disk space for downloads before they start.
+    
+    A reservation waits while the configured budget is used up or the free space
+    on the downloads volume, minus what running downloads have yet to write,
+    would drop below the headroom. Space is given back with release().
+    """
+    
+    def __init__(self, path, budget_bytes=None, headroom_bytes=0, recheck_interval=5):
+        self.path = path
+        self.budget_bytes = budget_bytes
+        self.headroom_bytes = headroom_bytes
+        self.recheck_interval = recheck_interval
+        self.reservations = {}
+        self._released = asyncio.Event()
+    
+    def reserved_bytes(self):
+        return sum(self.reservations.values())
+    
+    def outstanding_bytes(self):
+        """Bytes reserved but not yet written to disk by the reserving downloads"""
+        outstanding = 0
+        for file_path, size in self.reservations.items():
+            try:
+                allocated = os.stat(file_path).st_blocks * 512
+            except OSError:
+                allocated = 0
+            outstanding += max(0, size - allocated)
+        return outstanding
+    
+    def fits(self, size):
+        if not self.reservations:
+            return True  # Always admit one job, however large, or it would wait forever
+        if self.budget_bytes and self.reserved_bytes() + size > self.budget_bytes:
+            return False
+        free = shutil.disk_usage(self.path).free
+        return free - self.outstanding_bytes() - size >= self.headroom_bytes
+    
+    async def reserve(self, file_path, size):
+        """Wait until size bytes can be reserved for file_path, then reserve them"""
+        if not self.fits(size):
+            logger.info(f"Waiting for {size / (1024*1024):.1f}MB of disk space for {os.path.basename(file_path)}")
+            while not self.fits(size):
+                self._released.clear()
+                try:
+                    # Also re-check now and then, in case space was freed outside the uploader
+                    await asyncio.wait_for(self._released.wait(), self.recheck_interval)
+                except asyncio.TimeoutError:
+                    pass
+        self.reservations[file_path] = size
+    
+    def release(self, file_path):
+        """Give back the space reserved for file_path, if any"""
+        if self.reservations.pop(file_path, None) is not None:
+            self._released.set()
+
+class DownloadCache:
+    """On-disk cache of downloaded movies, addressed by content hash.
+    
+    Downloads stay here until their upload is confirmed, so a failed upload
+    can be retried, later in the run or in a later run on the same volume,
+    without downloading again. Entries are found by normalised source URL;
+    when the cache outgrows max_bytes the least recently used files that no
+    job is using are evicted. Several jobs can share one file (links to the
+    same content), so each file counts the jobs using it.
+    """
+    
+    def __init__(self, directory, max_bytes):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.index_path = os.path.join(directory, "index.json")
+        self.entries = {}  # content hash -> {"size", "source_urls", "etag", "last_used"}
+        self.in_use = {}  # content hash -> number of jobs using the file
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(directory, exist_ok=True)
+        self.load()
+    
+    def path(self, content_hash):
+        return os.path.join(self.directory, f"{content_hash}.mp4")
+    
+    def owns(self, file_path):
+        return os.path.dirname(os.path.abspath(file_path)) == os.path.abspath(self.directory)
+    
+    def size(self):
+        return sum(entry["size"] for entry in self.entries.values())
+    
+    def load(self):
+        try:
+            with open(self.index_path) as f:
+                entries = json.load(f)
+        except (OSError, ValueError):
+            entries = {}
+        # Forget entries whose file has been removed behind our back
+        self.entries = {content_hash: entry for content_hash, entry in entries.items() if os.path.exists(self.path(content_hash))}
+    
+    def save(self):
+        temp_path = f"{self.index_path}.tmp"
+        with open(temp_path, "w") as f:
+            json.dump(self.entries, f)
+        os.replace(temp_path, self.index_path)
+    
+    def lookup(self, source_url, size=None, etag=None):
+        """Return (content_hash, path) of a cached download of source_url, or None"""
+        for content_hash, entry in self.entries.items():
+            if source_url not in entry["source_urls"]:
+                continue
+            if (size and entry["size"] != size) or (etag and entry["etag"] and entry["etag"] != etag):
+                continue  # The file behind the link has changed
+            
+            entry["last_used"] = time.time()
+            self.in_use[content_hash] = self.in_use.get(content_hash, 0) + 1
+            self.hits += 1
+            self.save()
+            return content_hash, self.path(content_hash)
+        
+        self.misses += 1
+        return None
+    
+    async def add(self, file_path, content_hash, source_url, etag=None):
+        """Move a finished download into the cache and return its new path"""
+        path = self.path(content_hash)
+        entry = self.entries.get(content_hash)
+        if entry:
+            # Same bytes already cached from another link
+            os.remove(file_path)
+        else:
+            # A copy when the cache lives on another volume, so off the event loop
+            await asyncio.get_running_loop().run_in_executor(None, move_file, file_path, path)
+            entry = self.entries[content_hash] = {"size": os.path.getsize(path), "source_urls": [], "etag": etag}
+        
+        if source_url not in entry["source_urls"]:
+            entry["source_urls"].append(source_url)
+        entry["last_used"] = time.time()
+        self.in_use[content_hash] = self.in_use.get(content_hash, 0) + 1
+        
+        self.evict()
+        self.save()
+        return path
+    
+    def done(self, file_path, keep):
+        """A job has finished with a cached file; drop it unless keep (its upload didn't go through) or other jobs still use it"""
+        content_hash = os.path.splitext(os.path.basename(file_path))[0]
+        users = self.in_use.pop(content_hash, 0) - 1
+        if users > 0:
+            self.in_use[content_hash] = users
+        elif not keep and self.entries.pop(content_hash, None) is not None:
+            os.remove(file_path)
+            logger.info(f"Cleaned up cached file: {file_path}")
+        self.save()
+    
+    def evict(self):
+        """Remove least recently used files until the cache fits max_bytes again"""
+        total = self.size()
+        for content_hash, entry in sorted(self.entries.items(), key=lambda item: item[1]["last_used"]):
+            if total <= self.max_bytes:
+                break
+            if content_hash in self.in_use:
+                continue
+            
+            os.remove(self.path(content_hash))
+            del self.entries[content_hash]
+            total -= entry["size"]
+            logger.info(f"Evicted {content_hash[:12]} ({entry['size'] / (1024*1024):.1f}MB) from the download cache")
+
+class TelegramRateLimiter:
+    """Token bucket shared by every send to the Telegram group.
+    
+    Sends go out at up to `rate` per second with small bursts. A FloodWait
+    blocks all senders for the time Telegram asked for and halves the rate;
+    each successful send then slowly raises it back towards the configured rate.
+    """
+    
+    def __init__(self, rate, burst=3, min_rate=0.01, recovery=1.05):
+        self.max_rate = rate
+        self.rate = rate
+        self.burst = burst
+        self.min_rate = min_rate
+        self.recovery = recovery
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.blocked_until = 0
+        self._lock = asyncio.Lock()
+    
+    async def acquire(self):
+        """Wait for a send slot"""
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                if now < self.blocked_until:
+                    await asyncio.sleep(self.blocked_until - now)
+                    continue
+                
+                self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+    
+    def on_flood_wait(self, seconds):
+        self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
+        self.rate = max(self.min_rate, self.rate / 2)
+        self.tokens = 0
+        self.updated = self.blocked_until  # No tokens build up while blocked
+    
+    def on_success(self):
+        self.rate = min(self.max_rate, self.rate * self.recovery)
+
+class ThroughputEstimate:
+    """Exponentially weighted moving average of bytes per second"""
+    
+    def __init__(self, initial, alpha=0.3):
+        self.rate = initial
+        self.alpha = alpha
+    
+    def update(self, size, seconds):
+        if size > 0 and seconds > 0:
+            self.rate = self.alpha * (size / seconds) + (1 - self.alpha) * self.rate
+
+class TimeBudget:
+    """Admission control for runs that have to finish before a hard time limit.
+    
+    A movie is only started when its expected download plus upload time, from
+    the measured per-movie throughput and padded by `safety`, ends at least
+    `margin` seconds before the deadline. Once less than `margin` is left no
+    new movies are started and the run drains.
+    """
+    
+    def __init__(self, seconds, margin=120, safety=1.5):
+        self.deadline = time.monotonic() + seconds
+        self.margin = margin
+        self.safety = safety
+        self.download_rate = ThroughputEstimate(INITIAL_DOWNLOAD_RATE)
+        self.upload_rate = ThroughputEstimate(INITIAL_UPLOAD_RATE)
+    
+    def remaining(self):
+        return self.deadline - time.monotonic()
+    
+    def expired(self):
+        return self.remaining() <= self.margin
+    
+    def estimate(self, size):
+        """Expected seconds to download and upload size bytes"""
+        return size / self.download_rate.rate + size / self.upload_rate.rate
+    
+    def admits(self, size):
+        return self.estimate(size) * self.safety <= self.remaining() - self.margin
+
+class PartUploader:
+    """Pool of media connections that upload the 512 KB parts of every file in flight.
+    
+    Parts from all uploads share one bounded queue drained by `workers`
+    requests per connection, so one big file can use every connection while
+    several files together can't overload them. A failed part is retried on
+    its own, after a FloodWait for as long as Telegram asks.
+    """
+    
+    def __init__(self, client, connections, workers, queue_parts=8, attempts=PART_UPLOAD_ATTEMPTS):
+        self.client = client
+        self.connections = connections
+        self.workers = workers
+        self.attempts = attempts
+        self.queue = asyncio.Queue(max(queue_parts, connections * workers))
+        self.sessions = []
+        self.tasks = []
+        self._lock = asyncio.Lock()
+    
+    async def start(self):
+        """Open the media sessions and their workers, once"""
+        async with self._lock:
+            if self.sessions:
+                return
+            storage = self.client.storage
+            dc_id, auth_key, test_mode = await storage.dc_id(), await storage.auth_key(), await storage.test_mode()
+            for _ in range(self.connections):
+                session = Session(self.client, dc_id, auth_key, test_mode, is_media=True)
+                await session.start()
+                self.sessions.append(session)
+                self.tasks += [asyncio.create_task(self.worker(session)) for _ in range(self.workers)]
+    
+    async def stop(self):
+        for task in self.tasks:
+            task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+        for session in self.sessions:
+            await session.stop()
+        self.tasks = []
+        self.sessions = []
+    
+    async def put(self, rpc, errors):
+        """Queue one part request, waiting while the queue is full.
+        
+        Returns a future that completes once the part is done. A failure is
+        appended to `errors`, which is shared by all parts of the same file;
+        once it is non-empty the file's remaining parts are skipped.
+        """
+        await self.start()
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put((rpc, errors, future))
+        return future
+    
+    async def worker(self, session):
+        while True:
+            rpc, errors, future = await self.queue.get()
+            try:
+                if not errors:
+                    await self.invoke(session, rpc)
+            except Exception as e:
+                errors.append(e)
+            finally:
+                # The file's upload may have been cancelled while this part was queued
+                if not future.done():
+                    future.set_result(None)
+    
+    async def invoke(self, session, rpc):
+        for attempt in range(1, self.attempts + 1):
+            try:
+                return await session.invoke(rpc)
+            except Exception as e:
+                if attempt == self.attempts:
+                    raise
+                delay = e.value if isinstance(e, FloodWait) else 2 ** attempt
+                logger.warning(f"Upload of part {rpc.file_part} failed ({str(e)}), retry {attempt}/{self.attempts - 1} in {delay}s")
+                await asyncio.sleep(delay)
+
+class ContentHasher:
+    """Content hash of a file, computed while it downloads.
+    
+    The file is hashed in fixed 4 MB blocks and the hash is the SHA-256 of the
+    block digests. Blocks can therefore be hashed in any order, which parallel
+    range downloads need, and the hash doesn't depend on how the file was
+    fetched. Block digests are computed on a worker thread; blocks that were
+    never fed (e.g. downloaded by an earlier, interrupted run) are read back
+    from disk when the hash is finalized.
+    """
+    
+    BLOCK_SIZE = 4 * 1024 * 1024
+    MAX_PENDING = 8  # Blocks waiting for the hash thread before feeders wait
+    
+    def __init__(self, executor):
+        self.executor = executor
+        self.block_digests = {}
+        self.pending = []
+    
+    def feeder(self, offset=0):
+        """Start a sequential stream of bytes written from offset"""
+        return BlockHashFeeder(self, offset)
+    
+    def reset(self):
+        self.block_digests = {}
+        self.pending = []
+    
+    async def submit(self, index, data):
+        loop = asyncio.get_running_loop()
+        self.pending.append((index, loop.run_in_executor(self.executor, self.digest, data)))
+        if len(self.pending) > self.MAX_PENDING:
+            await self.collect(self.pending.pop(0))
+    
+    async def collect(self, pending):
+        index, future = pending
+        self.block_digests[index] = await future
+    
+    @staticmethod
+    def digest(data):
+        return hashlib.sha256(data).digest()
+    
+    @staticmethod
+    def digest_block(file_path, index, size):
+        with open(file_path, 'rb') as file:
+            return hashlib.sha256(os.pread(file.fileno(), size, index * ContentHasher.BLOCK_SIZE)).digest()
+    
+    async def finalize(self, file_path, file_size):
+        """Return the hex content hash, or None if blocks are missing and there is no file to read"""
+        while self.pending:
+            await self.collect(self.pending.pop(0))
+        
+        loop = asyncio.get_running_loop()
+        block_count = max(1, math.ceil(file_size / self.BLOCK_SIZE))
+        for index in range(block_count):
+            if index not in self.block_digests:
+                if file_path is None:
+                    return None
+                size = min(self.BLOCK_SIZE, file_size - index * self.BLOCK_SIZE)
+                self.block_digests[index] = await loop.run_in_executor(
+                    self.executor, self.digest_block, file_path, index, size
+                )
+        
+        return hashlib.sha256(b"".join(self.block_digests[index] for index in range(block_count))).hexdigest()
+
+class BlockHashFeeder:
+    """Cuts one sequential stream of downloaded bytes into whole blocks for a ContentHasher"""
+    
+    def __init__(self, hasher, offset):
+        self.hasher = hasher
+        self.skip = (-offset) % ContentHasher.BLOCK_SIZE  # Bytes before the first block boundary
+        self.block_start = offset + self.skip
+        self.buffer = bytearray()
+    
+    async def feed(self, data):
+        if self.skip:
+            skipped = min(self.skip, len(data))
+            self.skip -= skipped
+            data = data[skipped:]
+        
+        self.buffer += data
+        while len(self.buffer) >= ContentHasher.BLOCK_SIZE:
+            block = bytes(self.buffer[:ContentHasher.BLOCK_SIZE])
+            del self.buffer[:ContentHasher.BLOCK_SIZE]
+            await self.hasher.submit(self.block_start // ContentHasher.BLOCK_SIZE, block)
+            self.block_start += ContentHasher.BLOCK_SIZE
+    
+    async def close(self, at_eof):
+        """Finish the stream; a trailing partial block is only complete if it ends the file"""
+        if self.buffer and at_eof and not self.skip:
+            await self.hasher.submit(self.block_start // ContentHasher.BLOCK_SIZE, bytes(self.buffer))
+        self.buffer = bytearray()
+
 class TelegramMovieUploader:
-    def __init__(self, session_string, api_id, api_hash, group_id, mongodb_uri="mongodb://localhost:27017/", db_name="movie_uploader", max_file_size_mb=1900):
+    def __init__(self, session_string, api_id, api_hash, group_id, mongodb_uri="mongodb://localhost:27017/", db_name="movie_uploader", max_file_size_mb=1900,
+                 stream_uploads=False, stream_buffer_parts=8,
+                 download_connections=4, download_segment_size_mb=64,
+                 http_limit=32, http_limit_per_host=8, http_dns_cache_ttl=300, http_keepalive_timeout=60,
+                 http_connect_timeout=30, http_read_timeout=120, http_total_timeout=None,
+                 db_workers=4, db_max_pending=64,
+                 disk_budget_gb=None, disk_headroom_mb=1024, disk_default_reservation_mb=2048,
+                 telegram_sends_per_minute=20, part_upload_concurrency=3,
+                 upload_connections=2, upload_workers=4,
+                 retry_max_attempts=5, retry_base_delay=900, retry_max_delay=86400,
+                 runner_id=None, lease_seconds=600, probe_cache_ttl=86400, download_cache_gb=None,
+                 stall_min_rate_kb=32, stall_window=60, stall_idle_timeout=60, stall_restarts=3,
+                 write_buffer_mb=4, memory_file_threshold_mb=32, memory_budget_mb=256):
         self.session_string = session_string
         self.api_id = api_id
         self.api_hash = api_hash
         self.group_id = group_id
         self.max_file_size_bytes = max_file_size_mb * 1024 * 1024  # Convert MB to bytes
         
+        # Streaming mode: pipe the HTTP body straight into Telegram upload parts
+        self.stream_uploads = stream_uploads
+        self.stream_buffer_parts = stream_buffer_parts  # Bounded buffer, in 512 KB parts, shared with all uploads
+        
+        # Segmented downloads: parallel Range requests into a preallocated file
+        self.download_connections = download_connections
+        self.download_segment_size = download_segment_size_mb * 1024 * 1024
+        self.write_buffer_size = write_buffer_mb * 1024 * 1024  # Network chunks are coalesced into writes of this size
+        
+        # A connection slower than this (per window) or silent for the idle timeout is dropped
+        self.stall_min_rate = stall_min_rate_kb * 1024
+        self.stall_window = stall_window
+        self.stall_idle_timeout = stall_idle_timeout
+        self.stall_restarts = stall_restarts  # Fresh connections per range before giving up
+        
+        # Shared HTTP connection pool, created on first use and kept for the uploader's lifetime
+        self.http_session = None
+        self.http_limit = http_limit
+        self.http_limit_per_host = http_limit_per_host
+        self.http_dns_cache_ttl = http_dns_cache_ttl
+        self.http_keepalive_timeout = http_keepalive_timeout
+        self.http_timeout = aiohttp.ClientTimeout(
+            total=http_total_timeout,
+            connect=http_connect_timeout,
+            sock_read=http_read_timeout
+        )
+        
         # MongoDB setup
         self.mongo_client = MongoClient(mongodb_uri)
         self.db = self.mongo_client[db_name]
         self.collection = self.db.uploaded_movies
         
+        # Movies that failed for a transient reason, waiting for their next attempt
+        self.retry_queue = self.db.retry_queue
+        self.retry_max_attempts = retry_max_attempts
+        self.retry_base_delay = retry_base_delay  # Seconds, doubled after every failed attempt
+        self.retry_max_delay = retry_max_delay
+        
+        # Several runners can share the catalog; each movie is leased to one of them while it is worked on
+        self.runner_id = runner_id or f"{socket.gethostname()}-{os.getpid()}"
+        self.lease_seconds = lease_seconds
+        self.held_leases = set()
+        
+        # HEAD results per link, shared across runs and runners until they expire
+        self.probe_cache = self.db.probe_cache
+        self.probe_cache_ttl = probe_cache_ttl
+        
+        # Last catalog fetched (ETag/Last-Modified) and a movie_id -> hash snapshot of its entries
+        self.catalog_state = self.db.catalog_state
+        self.catalog_snapshot = self.db.catalog_snapshot
+        
+        # Set by process_all_movies when the run has a time limit
+        self.time_budget = None
+        
+        # Blocking pymongo calls run on their own threads; the semaphore bounds the backlog
+        self.db_executor = ThreadPoolExecutor(max_workers=db_workers, thread_name_prefix="mongo")
+        self.db_semaphore = asyncio.Semaphore(db_max_pending)
+        
+        # Content hashing runs next to downloads on its own threads
+        self.hash_executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix="hash")
+        
+        # Shared pacing for everything sent to group_id
+        self.rate_limiter = TelegramRateLimiter(rate=telegram_sends_per_minute / 60)
+        
+        # Parts of one movie upload concurrently; the part uploader's connections cap uploads across all movies
+        self.part_upload_concurrency = part_upload_concurrency
+        
         # Pyrogram client
         self.app = Client(
             "uploader_session",
@@ -42,9 +795,66 @@ class TelegramMovieUploader:
             api_hash=api_hash
         )
         
+        # File parts go out over several media connections at once, shared by all uploads
+        self.part_uploader = PartUploader(self.app, upload_connections, upload_workers, queue_parts=stream_buffer_parts)
+        
         # Create downloads directory
         self.downloads_dir = "downloads"
         os.makedirs(self.downloads_dir, exist_ok=True)
+        
+        # Disk admission control for concurrent downloads
+        self.disk_budget = DiskBudget(
+            self.downloads_dir,
+            budget_bytes=int(disk_budget_gb * 1024 ** 3) if disk_budget_gb else None,
+            headroom_bytes=disk_headroom_mb * 1024 * 1024
+        )
+        self.disk_default_reservation = disk_default_reservation_mb * 1024 * 1024  # When the size is unknown
+        
+        # Movies up to the threshold skip the disk when the memory budget has room
+        self.memory_file_threshold = memory_file_threshold_mb * 1024 * 1024
+        self.memory_budget = MemoryBudget(memory_budget_mb * 1024 * 1024)
+        
+        # Downloads whose upload hasn't been confirmed yet, kept for the next attempt
+        self.download_cache = DownloadCache(
+            os.path.join(self.downloads_dir, "cache"),
+            int(download_cache_gb * 1024 ** 3)
+        ) if download_cache_gb else None
+    
+    async def get_http_session(self):
+        """Return the shared aiohttp session, creating its connection pool on first use"""
+        if self.http_session is None or self.http_session.closed:
+            connector = aiohttp.TCPConnector(
+                limit=self.http_limit,
+                limit_per_host=self.http_limit_per_host,
+                ttl_dns_cache=self.http_dns_cache_ttl,
+                keepalive_timeout=self.http_keepalive_timeout
+            )
+            self.http_session = aiohttp.ClientSession(connector=connector, timeout=self.http_timeout)
+        return self.http_session
+    
+    async def close_http_session(self):
+        """Close the shared aiohttp session and its pooled connections"""
+        if self.http_session is not None and not self.http_session.closed:
+            await self.http_session.close()
+        self.http_session = None
+    
+    def get_pool_stats(self):
+        """Get connection pool usage, for sizing the HTTP limits"""
+        if self.http_session is None or self.http_session.closed:
+            return {}
+        
+        connector = self.http_session.connector
+        return {
+            "limit": connector.limit,
+            "limit_per_host": connector.limit_per_host,
+            "in_use": len(getattr(connector, '_acquired', ())),
+            "idle": sum(len(conns) for conns in getattr(connector, '_conns', {}).values()),
+            "waiting": sum(len(waiters) for waiters in getattr(connector, '_waiters', {}).values()),
+            "in_use_per_host": {
+                key.host: len(protocols)
+                for key, protocols in getattr(connector, '_acquired_per_host', {}).items() if protocols
+            }
+        }
     
     def convert_gdrive_url(self, gdrive_url):
         """Convert Google Drive sharing URL to direct download URL"""
@@ -64,339 +874,1888 @@ class TelegramMovieUploader:
             logger.error(f"Error converting Google Drive URL: {str(e)}")
             return gdrive_url
     
-    async def download_json_from_gdrive(self, gdrive_url, local_path="movies_data.json"):
-        """Download JSON file from Google Drive"""
+    def normalize_url(self, url):
+        """Canonical form of a movie link, so the same file is recognised under different URLs"""
+        drive_match = re.search(r'drive\.google\.com/(?:file/d/|uc\?(?:.*&)?id=|open\?(?:.*&)?id=)([a-zA-Z0-9_-]+)', url)
+        if drive_match:
+            return f"gdrive:{drive_match.group(1)}"
+        
+        parts = urlsplit(url.strip())
+        netloc = parts.netloc.lower()
+        if (parts.scheme == 'http' and netloc.endswith(':80')) or (parts.scheme == 'https' and netloc.endswith(':443')):
+            netloc = netloc.rsplit(':', 1)[0]
+        query = sorted(
+            (key, value) for key, value in parse_qsl(parts.query, keep_blank_values=True)
+            if not key.lower().startswith(TRACKING_PARAMS)
+        )
+        return urlunsplit((parts.scheme.lower(), netloc, parts.path or '/', urlencode(query), ''))
+    
+    def source_metadata(self, url, info):
+        """URL metadata stored with a movie and used to spot duplicates before downloading"""
+        return {
+            "source_url": self.normalize_url(url),
+            "etag": info.get("etag") if info else None,
+            "content_length": info.get("size") if info else None,
+            "last_modified": info.get("last_modified") if info else None
+        }
+    
+    async def save_catalog_response(self, response, local_path, first_chunk=b""):
+        """Stream a catalog HTTP response to disk in chunks instead of holding it in memory"""
+        async with aiofiles.open(local_path, 'wb') as file:
+            await file.write(first_chunk)
+            async for chunk in response.content.iter_chunked(CATALOG_CHUNK_SIZE):
+                await file.write(chunk)
+    
+    async def download_json_from_gdrive(self, gdrive_url, local_path="movies_data.json", validators=None):
+        """Download JSON file from Google Drive.
+        
+        With validators ({"etag", "last_modified"} from the last sync) the request
+        is conditional: CATALOG_NOT_MODIFIED is returned on 304, and otherwise
+        validators is updated from the response that delivered the JSON.
+        """
         try:
             direct_url = self.convert_gdrive_url(gdrive_url)
             logger.info(f"Downloading JSON from Google Drive...")
             
-            async with aiohttp.ClientSession() as session:
-                async with session.get(direct_url) as response:
-                    if response.status == 200:
-                        content = await response.text()
+            headers = {}
+            if validators and validators.get("etag"):
+                headers["If-None-Match"] = validators["etag"]
+            if validators and validators.get("last_modified"):
+                headers["If-Modified-Since"] = validators["last_modified"]
+            
+            session = await self.get_http_session()
+            async with session.get(direct_url, headers=headers) as response:
+                if response.status == 304:
+                    logger.info("JSON file not modified since the last sync")
+                    return CATALOG_NOT_MODIFIED
+                elif response.status == 200:
+                    # Sniff the start of the body to tell JSON from Google's download page
+                    first_chunk = await response.content.read(CATALOG_CHUNK_SIZE)
+                    
+                    if first_chunk.lstrip(b'\xef\xbb\xbf \t\r\n')[:1] in (b'[', b'{'):
+                        # It's JSON content
+                        await self.save_catalog_response(response, local_path, first_chunk)
+                        self.update_catalog_validators(validators, response)
+                        logger.info(f"JSON file downloaded successfully: {local_path}")
+                        return local_path
+                    else:
+                        # We might have hit Google's download confirmation page, which is small
+                        content = (first_chunk + await response.read()).decode('utf-8', errors='replace')
                         
-                        # Check if we got the actual JSON or Google's download page
-                        if content.strip().startswith('[') or content.strip().startswith('{'):
-                            # It's JSON content
-                            async with aiofiles.open(local_path, 'w', encoding='utf-8') as file:
-                                await file.write(content)
-                            logger.info(f"JSON file downloaded successfully: {local_path}")
-                            return local_path
-                        else:
-                            # We might have hit Google's download confirmation page
-                            # Try to extract the confirm URL
-                            confirm_match = re.search(r'action="([^"]*)".*?name="confirm".*?value="([^"]*)"', content, re.DOTALL)
-                            if confirm_match:
-                                confirm_url = confirm_match.group(1).replace('&amp;', '&')
-                                confirm_token = confirm_match.group(2)
-                                
-                                # Make confirmed download request
-                                confirm_data = {
-                                    'confirm': confirm_token,
-                                    'uuid': file_id if 'file_id' in locals() else ''
-                                }
-                                
-                                async with session.post(confirm_url, data=confirm_data) as confirm_response:
-                                    if confirm_response.status == 200:
-                                        json_content = await confirm_response.text()
-                                        async with aiofiles.open(local_path, 'w', encoding='utf-8') as file:
-                                            await file.write(json_content)
-                                        logger.info(f"JSON file downloaded successfully (with confirmation): {local_path}")
-                                        return local_path
+                        # Try to extract the confirm URL
+                        confirm_match = re.search(r'action="([^"]*)".*?name="confirm".*?value="([^"]*)"', content, re.DOTALL)
+                        if confirm_match:
+                            confirm_url = confirm_match.group(1).replace('&amp;', '&')
+                            confirm_token = confirm_match.group(2)
                             
-                            logger.error("Could not download JSON file - got HTML instead of JSON")
-                            return None
-                    else:
-                        logger.error(f"Failed to download JSON: HTTP {response.status}")
-                        return None
+                            # Make confirmed download request
+                            confirm_data = {
+                                'confirm': confirm_token,
+                                'uuid': file_id if 'file_id' in locals() else ''
+                            }
+                            
+                            async with session.post(confirm_url, data=confirm_data) as confirm_response:
+                                if confirm_response.status == 200:
+                                    await self.save_catalog_response(confirm_response, local_path)
+                                    self.update_catalog_validators(validators, confirm_response)
+                                    logger.info(f"JSON file downloaded successfully (with confirmation): {local_path}")
+                                    return local_path
                         
+                        logger.error("Could not download JSON file - got HTML instead of JSON")
+                        return None
+                else:
+                    logger.error(f"Failed to download JSON: HTTP {response.status}")
+                    return None
+                    
         except Exception as e:
             logger.error(f"Error downloading JSON from Google Drive: {str(e)}")
             return None
     
-    def is_already_uploaded(self, movie_id):
-        """Check if movie is already uploaded to Telegram"""
-        return self.collection.find_one({"movie_id": movie_id, "status": "uploaded"}) is not None
+    def update_catalog_validators(self, validators, response):
+        """Remember the cache validators of the response a catalog was read from"""
+        if validators is not None:
+            validators["etag"] = response.headers.get('etag')
+            validators["last_modified"] = response.headers.get('last-modified')
+    
+    def load_catalog_state(self, catalog_source):
+        """ETag/Last-Modified of the catalog as of the last complete sync"""
+        state = self.catalog_state.find_one({"_id": catalog_source}) or {}
+        return {"etag": state.get("etag"), "last_modified": state.get("last_modified")}
+    
+    def catalog_entry_hash(self, movie_data):
+        """Short hash of what matters in a catalog entry, to spot changed entries"""
+        return hashlib.sha1(f"{movie_data['name']}\0{movie_data['link']}".encode('utf-8')).hexdigest()[:16]
+    
+    def reset_changed_movies(self, movie_ids):
+        """Give movies whose catalog entry changed another chance, even after a permanent failure"""
+        self.collection.update_many(
+            {"movie_id": {"$in": movie_ids}, "status": {"$in": ["failed", "retrying"]}},
+            {"$set": {"status": "failed", "retryable": True}, "$unset": {"next_attempt_at": ""}}
+        )
+        self.retry_queue.delete_many({"movie_id": {"$in": movie_ids}})
+    
+    def diff_catalog_batch(self, batch, synced_at):
+        """Compare a batch of catalog entries with the snapshot, and record them in it.
+        
+        Returns (entries to work on, counts). Unchanged entries that were already
+        handled are dropped without further lookups; the rest are checked
+        against the uploads like iter_pending_movies does. Entries still to do
+        keep their name and link in the snapshot, so runs where the catalog
+        hasn't changed can find them without downloading it.
+        """
+        hashes = {movie_data["id"]: self.catalog_entry_hash(movie_data) for movie_data in batch}
+        snapshot = {
+            record["movie_id"]: record
+            for record in self.catalog_snapshot.find(
+                {"movie_id": {"$in": list(hashes)}},
+                {"movie_id": 1, "hash": 1, "pending": 1, "_id": 0}
+            )
+        }
+        
+        counts = {"unchanged": 0, "skipped": 0, "not_retried": 0}
+        candidates = []
+        changed = []
+        for movie_data in batch:
+            known = snapshot.get(movie_data["id"])
+            if known and known["hash"] == hashes[movie_data["id"]] and not known["pending"]:
+                counts["unchanged"] += 1
+                continue
+            if known and known["hash"] != hashes[movie_data["id"]]:
+                changed.append(movie_data["id"])
+            candidates.append(movie_data)
+        
+        if changed:
+            self.reset_changed_movies(changed)
+        settled = self.load_settled_ids([movie_data["id"] for movie_data in candidates])
+        
+        work = []
+        operations = []
+        for movie_data in candidates:
+            status = settled.get(movie_data["id"])
+            if status:
+                counts["skipped" if status == "uploaded" else "not_retried"] += 1
+                update = {"$set": {"hash": hashes[movie_data["id"]], "pending": False}, "$unset": {"name": "", "link": "", "synced_at": ""}}
+            else:
+                work.append(movie_data)
+                update = {"$set": {
+                    "hash": hashes[movie_data["id"]],
+                    "pending": True,
+                    "name": movie_data["name"],
+                    "link": movie_data["link"],
+                    "synced_at": synced_at
+                }}
+            operations.append(UpdateOne({"movie_id": movie_data["id"]}, update, upsert=True))
+        
+        if operations:
+            self.catalog_snapshot.bulk_write(operations, ordered=False)
+        return work, counts
+    
+    def finish_catalog_sync(self, catalog_source, validators, synced_at):
+        """Save the validators of a fully read catalog and forget pending entries it no longer has"""
+        self.catalog_state.update_one(
+            {"_id": catalog_source},
+            {"$set": {"etag": validators.get("etag"), "last_modified": validators.get("last_modified"), "synced_at": synced_at}},
+            upsert=True
+        )
+        self.catalog_snapshot.delete_many({"pending": True, "synced_at": {"$lt": synced_at}})
+    
+    def load_pending_snapshot_batch(self, after=None):
+        """Next CATALOG_BATCH pending snapshot entries, in movie_id order"""
+        query = {"pending": True}
+        if after is not None:
+            query["movie_id"] = {"$gt": after}
+        cursor = self.catalog_snapshot.find(query, {"movie_id": 1, "name": 1, "link": 1, "_id": 0}).sort("movie_id", 1).limit(CATALOG_BATCH)
+        return [{"id": record["movie_id"], "name": record["name"], "link": record["link"]} for record in cursor]
+    
+    async def iter_pending_snapshot(self):
+        """Yield the entries still to do from the snapshot, for when the catalog hasn't changed"""
+        after = None
+        while True:
+            batch = await self.run_db(self.load_pending_snapshot_batch, after)
+            for movie_data in batch:
+                yield movie_data
+            if len(batch) < CATALOG_BATCH:
+                return
+            after = batch[-1]["id"]
+    
+    async def iter_catalog(self, json_file_path):
+        """Yield catalog entries one by one from a JSON array or NDJSON/JSONL file.
+        
+        The file is read in chunks and parsed incrementally, so entries are
+        available as soon as they are read and the whole catalog is never in memory.
+        Entries that aren't valid JSON or lack an id, name or link are logged and skipped.
+        """
+        decoder = json.JSONDecoder()
+        
+        def is_valid(entry):
+            if isinstance(entry, dict) and all(entry.get(key) not in (None, '') for key in ("id", "name", "link")):
+                return True
+            logger.warning(f"Skipping catalog entry without id, name and link: {str(entry)[:200]}")
+            return False
+        
+        async with aiofiles.open(json_file_path, 'r', encoding='utf-8-sig') as file:
+            buffer = (await file.read(CATALOG_CHUNK_SIZE)).lstrip()
+            
+            if not buffer.startswith('['):
+                # NDJSON / JSON Lines: one entry per line
+                while True:
+                    chunk = await file.read(CATALOG_CHUNK_SIZE)
+                    lines = (buffer + chunk).split('\n')
+                    buffer = lines.pop() if chunk else ''  # Keep a cut-off last line for the next chunk
+                    for line in lines:
+                        if not line.strip():
+                            continue
+                        try:
+                            entry = json.loads(line)
+                        except ValueError as e:
+                            logger.warning(f"Skipping unreadable catalog line ({str(e)}): {line[:200]}")
+                            continue
+                        if is_valid(entry):
+                            yield entry
+                    if not chunk:
+                        return
+            
+            # JSON array: decode one element at a time, reading more whenever an element is cut off
+            position = 1
+            eof = False
+            while True:
+                while position < len(buffer) and buffer[position] in ' \t\r\n,':
+                    position += 1
+                
+                if position < len(buffer) and buffer[position] == ']':
+                    return
+                
+                try:
+                    entry, end = decoder.raw_decode(buffer, position)
+                    complete = end < len(buffer) or eof
+                except json.JSONDecodeError:
+                    if eof:
+                        raise
+                    complete = False
+                
+                if complete:
+                    if is_valid(entry):
+                        yield entry
+                    position = end
+                    continue
+                
+                chunk = await file.read(CATALOG_CHUNK_SIZE)
+                eof = not chunk
+                buffer = buffer[position:] + chunk
+                position = 0
+    
+    async def run_db(self, func, *args, **kwargs):
+        """Run a blocking database call on the MongoDB executor instead of the event loop"""
+        async with self.db_semaphore:
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(self.db_executor, functools.partial(func, *args, **kwargs))
+    
+    def ensure_indexes(self):
+        """Create the indexes the uploader's lookups rely on"""
+        try:
+            self.collection.create_index("movie_id", unique=True)
+        except OperationFailure as e:
+            # Lease claims only notice a lost race through this index, running without it would upload twice
+            raise RuntimeError(f"Could not create unique movie_id index, remove duplicate movie records first: {str(e)}") from e
+        self.collection.create_index([("status", 1), ("movie_id", 1)])
+        self.collection.create_index("content_hash", sparse=True)
+        self.collection.create_index("source_url", sparse=True)
+        self.collection.create_index([("etag", 1), ("content_length", 1)], sparse=True)
+        self.retry_queue.create_index("movie_id", unique=True)
+        self.retry_queue.create_index("next_attempt_at")
+        self.probe_cache.create_index("source_url", unique=True)
+        try:
+            self.probe_cache.create_index("probed_at", expireAfterSeconds=self.probe_cache_ttl)
+        except OperationFailure as e:
+            if e.code != 85:  # IndexOptionsConflict: the TTL has changed since the index was made
+                raise
+            self.db.command("collMod", self.probe_cache.name, index={"keyPattern": {"probed_at": 1}, "expireAfterSeconds": self.probe_cache_ttl})
+            logger.info(f"Probe cache TTL changed to {self.probe_cache_ttl}s")
+        self.catalog_snapshot.create_index("movie_id", unique=True)
+        self.catalog_snapshot.create_index([("pending", 1), ("movie_id", 1)])
+    
+    def load_settled_ids(self, movie_ids):
+        """Return {movie_id: status} for movies that need no new attempt, using projected $in queries.
+        
+        That is movies already uploaded, failed for good, or waiting in the retry queue.
+        """
+        settled = {}
+        for start in range(0, len(movie_ids), UPLOADED_ID_BATCH):
+            batch = movie_ids[start:start + UPLOADED_ID_BATCH]
+            cursor = self.collection.find(
+                {
+                    "movie_id": {"$in": batch},
+                    "$or": [
+                        {"status": {"$in": ["uploaded", "retrying"]}},
+                        {"status": "failed", "retryable": False}
+                    ]
+                },
+                {"movie_id": 1, "status": 1, "_id": 0}
+            )
+            settled.update((record["movie_id"], record["status"]) for record in cursor)
+        return settled
+    
+    def is_already_uploaded(self, movie_id):
+        """Check if movie is already uploaded to Telegram"""
+        return self.collection.find_one({"movie_id": movie_id, "status": "uploaded"}) is not None
+    
+    def claim_movie(self, movie_id, movie_name):
+        """Atomically lease a movie to this runner; False if it is uploaded or another runner holds it.
+        
+        Movies with no record are claimed by upserting one. When another runner
+        got there first, the unique movie_id index turns that upsert into a
+        DuplicateKeyError instead of a second record.
+        """
+        now = datetime.now(timezone.utc)  # Leases are compared across runners, whatever their timezone
+        try:
+            self.collection.find_one_and_update(
+                {
+                    "movie_id": movie_id,
+                    "$or": [
+                        {"status": {"$exists": False}},
+                        {"status": "failed", "retryable": {"$ne": False}},
+                        {"status": "retrying", "next_attempt_at": {"$lte": datetime.now()}},
+                        {"status": "in_progress", "lease_expires_at": {"$lte": now}}
+                    ]
+                },
+                {
+                    "$set": {
+                        "movie_id": movie_id,
+                        "movie_name": movie_name,
+                        "status": "in_progress",
+                        "owner": self.runner_id,
+                        "claimed_at": now,
+                        "lease_expires_at": now + timedelta(seconds=self.lease_seconds)
+                    }
+                },
+                upsert=True
+            )
+        except DuplicateKeyError:
+            return False
+        
+        self.held_leases.add(movie_id)
+        return True
+    
+    def renew_leases(self):
+        """Push back the lease expiry of every movie this runner is working on"""
+        movie_ids = list(self.held_leases)
+        if not movie_ids:
+            return
+        
+        result = self.collection.update_many(
+            {"movie_id": {"$in": movie_ids}, "status": "in_progress", "owner": self.runner_id},
+            {"$set": {"lease_expires_at": datetime.now(timezone.utc) + timedelta(seconds=self.lease_seconds)}}
+        )
+        if result.matched_count < len(movie_ids):
+            logger.warning(f"Renewed {result.matched_count} of {len(movie_ids)} leases, the rest were finished or taken over meanwhile")
+    
+    def release_lease(self, movie_id):
+        """Hand a claimed movie back untouched by expiring its lease, so any runner can claim it"""
+        self.collection.update_one(
+            {"movie_id": movie_id, "status": "in_progress", "owner": self.runner_id},
+            {"$set": {"lease_expires_at": datetime.now(timezone.utc)}}
+        )
+        self.held_leases.discard(movie_id)
+    
+    async def heartbeat(self):
+        """Renew this runner's leases every third of the lease time until cancelled"""
+        while True:
+            await asyncio.sleep(self.lease_seconds / 3)
+            try:
+                await self.run_db(self.renew_leases)
+            except Exception as e:
+                logger.warning(f"Lease heartbeat failed: {str(e)}")
+    
+    def mark_as_uploaded(self, movie_id, movie_name, file_paths, message_ids=None, is_split=False, total_parts=1,
+                         content_hash=None, file_ids=None, reused_from=None, source_meta=None):
+        """Mark movie as uploaded in database"""
+        record = {
+            "movie_id": movie_id,
+            "movie_name": movie_name,
+            "file_paths": file_paths if isinstance(file_paths, list) else [file_paths],
+            "status": "uploaded",
+            "uploaded_at": datetime.now(),
+            "message_ids": message_ids if isinstance(message_ids, list) else [message_ids] if message_ids else [],
+            "is_split": is_split,
+            "total_parts": total_parts
+        }
+        
+        # Lets later movies with the same bytes reuse this upload
+        if content_hash:
+            record["content_hash"] = content_hash
+        if file_ids:
+            record["file_ids"] = file_ids
+        if reused_from is not None:
+            record["reused_from"] = reused_from
+        if source_meta:
+            record.update({key: value for key, value in source_meta.items() if value is not None})
+        
+        self.collection.update_one({"movie_id": movie_id}, {"$set": record, "$unset": {"owner": "", "lease_expires_at": ""}}, upsert=True)
+        self.retry_queue.delete_one({"movie_id": movie_id})
+        self.settle_snapshot_entry(movie_id)
+        self.held_leases.discard(movie_id)
+    
+    def settle_snapshot_entry(self, movie_id):
+        """Mark a catalog snapshot entry as handled, so unchanged catalogs don't offer it again"""
+        self.catalog_snapshot.update_one(
+            {"movie_id": movie_id, "pending": True},
+            {"$set": {"pending": False}, "$unset": {"name": "", "link": "", "synced_at": ""}}
+        )
+    
+    def find_uploaded_by_source(self, source_meta, movie_id):
+        """Find another uploaded movie with the same normalised link, or the same ETag and size"""
+        matches = [{"source_url": source_meta["source_url"]}]
+        if source_meta["etag"] and source_meta["content_length"]:
+            matches.append({"etag": source_meta["etag"], "content_length": source_meta["content_length"]})
+        
+        return self.collection.find_one({
+            "$or": matches,
+            "status": "uploaded",
+            "movie_id": {"$ne": movie_id}
+        })
+    
+    def find_uploaded_by_hash(self, content_hash, movie_id):
+        """Find another movie already uploaded with exactly the same content"""
+        return self.collection.find_one({
+            "content_hash": content_hash,
+            "status": "uploaded",
+            "movie_id": {"$ne": movie_id}
+        })
+    
+    def mark_as_failed(self, movie_id, movie_name, error_message, failure_class=FAILURE_UNKNOWN, movie_url=None, retry_after=None):
+        """Mark movie as failed in database, queueing another attempt if the failure is transient.
+        
+        Returns whether another attempt was queued.
+        """
+        now = datetime.now()
+        record = {
+            "movie_id": movie_id,
+            "movie_name": movie_name,
+            "status": "failed",
+            "error": error_message,
+            "failure_class": failure_class,
+            "retryable": False,
+            "failed_at": now
+        }
+        
+        if failure_class in RETRYABLE_FAILURES and movie_url:
+            entry = self.retry_queue.find_one_and_update(
+                {"movie_id": movie_id},
+                {
+                    "$inc": {"attempts": 1},
+                    "$set": {"movie_name": movie_name, "link": movie_url, "failure_class": failure_class, "error": error_message, "failed_at": now}
+                },
+                upsert=True,
+                return_document=ReturnDocument.AFTER
+            )
+            record["attempts"] = entry["attempts"]
+            
+            if entry["attempts"] < self.retry_max_attempts:
+                # Exponential backoff, but never sooner than Telegram asked us to wait
+                delay = min(self.retry_max_delay, self.retry_base_delay * 2 ** (entry["attempts"] - 1))
+                if retry_after:
+                    delay = max(delay, retry_after)
+                next_attempt_at = now + timedelta(seconds=delay)
+                self.retry_queue.update_one({"movie_id": movie_id}, {"$set": {"next_attempt_at": next_attempt_at}})
+                record.update({"status": "retrying", "retryable": True, "next_attempt_at": next_attempt_at})
+                logger.info(f"Retry {entry['attempts']}/{self.retry_max_attempts - 1} of {movie_name} scheduled for {next_attempt_at:%Y-%m-%d %H:%M} ({failure_class})")
+            else:
+                self.retry_queue.delete_one({"movie_id": movie_id})
+                logger.warning(f"Giving up on {movie_name} after {entry['attempts']} attempts")
+        
+        self.collection.update_one({"movie_id": movie_id}, {"$set": record, "$unset": {"owner": "", "lease_expires_at": ""}}, upsert=True)
+        self.settle_snapshot_entry(movie_id)
+        self.held_leases.discard(movie_id)
+        return record["retryable"]
+    
+    def load_due_retries(self):
+        """Return catalog-style entries for queued retries whose backoff has passed"""
+        cursor = self.retry_queue.find(
+            {"next_attempt_at": {"$lte": datetime.now()}},
+            {"movie_id": 1, "movie_name": 1, "link": 1, "_id": 0}
+        ).sort("next_attempt_at", 1)
+        return [{"id": entry["movie_id"], "name": entry["movie_name"], "link": entry["link"]} for entry in cursor]
+    
+    def classify_failure(self, error):
+        """Map an exception from a download or upload to one of the FAILURE_* classes"""
+        if isinstance(error, FloodWait):
+            return FAILURE_TELEGRAM_FLOOD
+        if isinstance(error, (HTTPStatusError, aiohttp.ClientResponseError)):
+            if 400 <= error.status < 500 and error.status not in TRANSIENT_HTTP_STATUSES:
+                return FAILURE_PERMANENT_HTTP
+            return FAILURE_TRANSIENT_NETWORK
+        if isinstance(error, OSError) and error.errno in (errno.ENOSPC, errno.EDQUOT):
+            return FAILURE_DISK
+        if isinstance(error, (aiohttp.ClientError, asyncio.TimeoutError, OSError)):
+            return FAILURE_TRANSIENT_NETWORK
+        return FAILURE_UNKNOWN
+    
+    async def probe_url(self, session, url):
+        """HEAD a download URL for its size, range support and cache validators"""
+        try:
+            async with session.head(url, allow_redirects=True) as response:
+                if response.status not in HEAD_UNSUPPORTED_STATUSES:
+                    return {
+                        "status": response.status,
+                        "size": int(response.headers.get('content-length', 0)),
+                        "accept_ranges": response.headers.get('accept-ranges', '').lower() == 'bytes',
+                        "etag": response.headers.get('etag'),
+                        "last_modified": response.headers.get('last-modified')
+                    }
+        except Exception as e:
+            logger.warning(f"HEAD request failed for {url}: {str(e)}")
+            return None
+        
+        # HEAD refused, ask for the first byte instead; Content-Range carries the full size
+        try:
+            async with session.get(url, headers={"Range": "bytes=0-0"}) as response:
+                content_range = response.headers.get('content-range', '')
+                ranged = response.status == 206 and '/' in content_range and not content_range.endswith('/*')
+                return {
+                    "status": 200 if ranged else response.status,
+                    "size": int(content_range.rsplit('/', 1)[1]) if ranged else int(response.headers.get('content-length', 0)),
+                    "accept_ranges": ranged,
+                    "etag": response.headers.get('etag'),
+                    "last_modified": response.headers.get('last-modified')
+                }
+        except Exception as e:
+            logger.warning(f"Range probe failed for {url}: {str(e)}")
+            return None
+    
+    def load_cached_probes(self, urls):
+        """Return {url: probe} for the urls with an unexpired cached probe"""
+        source_urls = {self.normalize_url(url): url for url in urls}
+        cursor = self.probe_cache.find(
+            {"source_url": {"$in": list(source_urls)}},
+            {"_id": 0, "probed_at": 0}
+        )
+        return {source_urls[record.pop("source_url")]: record for record in cursor}
+    
+    def save_probes(self, probes):
+        """Cache {url: probe} results; probes that failed outright (None) are not cached"""
+        now = datetime.now()
+        operations = [
+            UpdateOne({"source_url": self.normalize_url(url)}, {"$set": dict(info, source_url=self.normalize_url(url), probed_at=now)}, upsert=True)
+            for url, info in probes.items() if info
+        ]
+        if operations:
+            self.probe_cache.bulk_write(operations, ordered=False)
+    
+    async def get_probe(self, url):
+        """Probe one URL, answering from the probe cache when possible.
+        
+        Returns (probe, fresh), fresh being False for an answer from the cache.
+        """
+        cached = await self.run_db(self.load_cached_probes, [url])
+        if url in cached:
+            return cached[url], False
+        
+        info = await self.probe_url(await self.get_http_session(), url)
+        await self.run_db(self.save_probes, {url: info})
+        return info, True
+    
+    async def probe_movies(self, movies):
+        """Attach a probe as "info" to every catalog entry, HEAD-ing uncached links in parallel.
+        
+        Returns how many entries were answered from the cache.
+        """
+        cached = await self.run_db(self.load_cached_probes, [movie_data["link"] for movie_data in movies])
+        missing = [movie_data for movie_data in movies if movie_data["link"] not in cached]
+        
+        session = await self.get_http_session()
+        semaphore = asyncio.Semaphore(self.http_limit)
+        
+        async def probe(movie_data):
+            async with semaphore:
+                return movie_data["link"], await self.probe_url(session, movie_data["link"])
+        
+        probed = dict(await asyncio.gather(*[probe(movie_data) for movie_data in missing]))
+        await self.run_db(self.save_probes, probed)
+        
+        for movie_data in movies:
+            movie_data["info"] = cached.get(movie_data["link"]) or probed.get(movie_data["link"])
+        return len(movies) - len(missing)
+    
+    def log_download_progress(self, movie_name, previous, downloaded, total_size):
+        """Log download progress every time another 50MB has arrived"""
+        step = 1024 * 1024 * 50
+        if total_size > 0 and previous // step != downloaded // step:
+            progress = (downloaded / total_size) * 100
+            logger.info(f"Download progress for {movie_name}: {progress:.1f}%")
+    
+    async def download_file(self, url, file_path, movie_name, movie_id=None, hasher=None, info=None):
+        """Download MP4 file from URL, resumably over ranged connections when the server allows it.
+        
+        info must be a probe taken just now; without one the link is HEAD-ed
+        here rather than taken from the probe cache, so a saved partial
+        download is only resumed against the file as it is now.
+        Raises on failure, so the caller can tell why the download failed.
+        """
+        logger.info(f"Starting download: {movie_name}")
+        
+        session = await self.get_http_session()
+        if info is None:
+            info = await self.probe_url(session, url)
+            if info:
+                await self.run_db(self.save_probes, {url: info})
+        if info and info["status"] == 200 and info["accept_ranges"] and info["size"] > 0:
+            try:
+                await self.download_segmented(session, url, file_path, movie_name, info, movie_id, hasher)
+                logger.info(f"Download completed: {movie_name}")
+                return
+            except RangesNotSupported as e:
+                logger.warning(f"Ranged download not possible for {movie_name} ({str(e)}), using single stream")
+                await self.discard_partial_download(file_path, movie_id)
+                if hasher:
+                    hasher.reset()
+        
+        await self.download_single_stream(session, url, file_path, movie_name, hasher)
+    
+    async def iter_monitored(self, response):
+        """Yield response body chunks, raising DownloadStalled if it goes idle or too slow"""
+        monitor = StallMonitor(self.stall_min_rate, self.stall_window)
+        while True:
+            try:
+                async with asyncio.timeout(self.stall_idle_timeout):
+                    chunk = await response.content.read(READ_CHUNK_SIZE)
+            except TimeoutError:
+                raise DownloadStalled(f"no data for {self.stall_idle_timeout}s")
+            if not chunk:
+                return
+            
+            monitor.update(len(chunk))
+            yield chunk
+    
+    def monitored_reader(self, response):
+        """`await read(size)` for exactly size bytes of a response body, with the checks of iter_monitored.
+        
+        Time between reads, while the caller catches up, doesn't count against the rate.
+        """
+        monitor = StallMonitor(self.stall_min_rate, self.stall_window)
+        last_read = time.monotonic()
+        
+        async def read(size):
+            nonlocal last_read
+            monitor.exclude(time.monotonic() - last_read)
+            data = bytearray()
+            while len(data) < size:
+                try:
+                    async with asyncio.timeout(self.stall_idle_timeout):
+                        chunk = await response.content.read(min(READ_CHUNK_SIZE, size - len(data)))
+                except TimeoutError:
+                    raise DownloadStalled(f"no data for {self.stall_idle_timeout}s")
+                if not chunk:
+                    raise asyncio.IncompleteReadError(bytes(data), size)
+                
+                monitor.update(len(chunk))
+                data += chunk
+            
+            last_read = time.monotonic()
+            return bytes(data)
+        
+        return read
+    
+    async def download_single_stream(self, session, url, file_path, movie_name, hasher=None):
+        """Download MP4 file over one GET request"""
+        async with session.get(url) as response:
+            if response.status == 200:
+                total_size = int(response.headers.get('content-length', 0))
+                downloaded = 0
+                feeder = hasher.feeder(0) if hasher else None
+                
+                fd = os.open(file_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+                try:
+                    if total_size:
+                        await asyncio.get_running_loop().run_in_executor(None, preallocate, fd, total_size)
+                    writer = BufferedFileWriter(fd, 0, self.write_buffer_size)
+                    async for chunk in self.iter_monitored(response):
+                        await writer.write(chunk)
+                        if feeder:
+                            await feeder.feed(chunk)
+                        self.log_download_progress(movie_name, downloaded, downloaded + len(chunk), total_size)
+                        downloaded += len(chunk)
+                    await writer.flush()
+                    
+                    # Content-Length can overstate the body; don't leave preallocated zeros behind
+                    os.ftruncate(fd, downloaded)
+                finally:
+                    os.close(fd)
+                
+                if feeder:
+                    await feeder.close(at_eof=True)
+                
+                logger.info(f"Download completed: {movie_name}")
+            else:
+                raise HTTPStatusError(response.status)
+    
+    async def download_to_memory(self, url, movie_name, size, hasher):
+        """Download a small movie of at most size bytes into memory over one GET request"""
+        session = await self.get_http_session()
+        async with session.get(url) as response:
+            if response.status != 200:
+                raise HTTPStatusError(response.status)
+            
+            data = bytearray()
+            feeder = hasher.feeder(0)
+            async for chunk in self.iter_monitored(response):
+                data += chunk
+                if len(data) > size:
+                    raise SizeChanged(f"{movie_name} is larger than the {size} bytes announced")
+                await feeder.feed(chunk)
+            await feeder.close(at_eof=True)
+        
+        return bytes(data)
+    
+    def download_state_path(self, file_path):
+        """Sidecar file holding the progress of a partial download"""
+        return f"{file_path}.state.json"
+    
+    async def load_download_state(self, file_path, movie_id, url, info):
+        """Return saved segment progress for a partial download if it still matches the remote file"""
+        state = None
+        state_path = self.download_state_path(file_path)
+        
+        if os.path.exists(state_path):
+            try:
+                async with aiofiles.open(state_path, 'r', encoding='utf-8') as file:
+                    state = json.loads(await file.read())
+            except Exception as e:
+                logger.warning(f"Ignoring unreadable download state {state_path}: {str(e)}")
+        
+        if state is None and movie_id is not None:
+            record = await self.run_db(self.collection.find_one, {"movie_id": movie_id}, {"download_state": 1})
+            state = record.get("download_state") if record else None
+        
+        if not state or not os.path.exists(file_path):
+            return None
+        
+        # Only resume if the partial file and the remote file are still the same ones
+        if (state.get("url") != url or state.get("size") != info["size"]
+                or os.path.getsize(file_path) != info["size"]
+                or state.get("etag") != info["etag"]
+                or state.get("last_modified") != info["last_modified"]):
+            logger.info(f"Saved download state for {file_path} is stale, starting over")
+            return None
+        
+        return state
+    
+    async def save_download_state(self, file_path, movie_id, state, save_to_db=True):
+        """Persist segment progress next to the file and, optionally, in MongoDB"""
+        state["bytes_done"] = sum(done for _, _, done in state["segments"])
+        state["updated_at"] = datetime.now().isoformat()
+        
+        state_path = self.download_state_path(file_path)
+        async with aiofiles.open(f"{state_path}.tmp", 'w', encoding='utf-8') as file:
+            await file.write(json.dumps(state))
+        os.replace(f"{state_path}.tmp", state_path)
+        
+        if save_to_db and movie_id is not None:
+            await self.run_db(
+                self.collection.update_one,
+                {"movie_id": movie_id},
+                {"$set": {"movie_id": movie_id, "download_state": state}},
+                upsert=True
+            )
     
-    def mark_as_uploaded(self, movie_id, movie_name, file_paths, message_ids=None, is_split=False, total_parts=1):
-        """Mark movie as uploaded in database"""
-        self.collection.update_one(
-            {"movie_id": movie_id},
-            {
-                "$set": {
-                    "movie_id": movie_id,
-                    "movie_name": movie_name,
-                    "file_paths": file_paths if isinstance(file_paths, list) else [file_paths],
-                    "status": "uploaded",
-                    "uploaded_at": datetime.now(),
-                    "message_ids": message_ids if isinstance(message_ids, list) else [message_ids] if message_ids else [],
-                    "is_split": is_split,
-                    "total_parts": total_parts
-                }
-            },
-            upsert=True
-        )
+    async def clear_download_state(self, file_path, movie_id):
+        """Forget the progress of a download that completed or can't be resumed"""
+        state_path = self.download_state_path(file_path)
+        if os.path.exists(state_path):
+            os.remove(state_path)
+        
+        if movie_id is not None:
+            await self.run_db(
+                self.collection.update_one,
+                {"movie_id": movie_id, "download_state": {"$exists": True}},
+                {"$unset": {"download_state": ""}}
+            )
     
-    def mark_as_failed(self, movie_id, movie_name, error_message):
-        """Mark movie as failed in database"""
-        self.collection.update_one(
-            {"movie_id": movie_id},
-            {
-                "$set": {
-                    "movie_id": movie_id,
-                    "movie_name": movie_name,
-                    "status": "failed",
-                    "error": error_message,
-                    "failed_at": datetime.now()
-                }
-            },
-            upsert=True
-        )
+    async def discard_partial_download(self, file_path, movie_id):
+        """Delete a partial download that won't be resumed, along with its progress"""
+        await self.clear_download_state(file_path, movie_id)
+        if os.path.exists(file_path):
+            os.remove(file_path)
+            logger.info(f"Removed partial download: {file_path}")
     
-    async def download_file(self, url, file_path, movie_name):
-        """Download MP4 file from URL"""
+    async def download_segmented(self, session, url, file_path, movie_name, info, movie_id=None, hasher=None):
+        """Download MP4 file as parallel byte ranges written into a preallocated file.
+        
+        Progress is saved per segment, so an interrupted download continues
+        from where it stopped on the next attempt.
+        """
+        total_size = info["size"]
+        state = await self.load_download_state(file_path, movie_id, url, info)
+        
+        if state:
+            logger.info(f"Resuming download of {movie_name} from {state['bytes_done'] / (1024*1024):.1f}MB")
+        else:
+            state = {
+                "url": url,
+                "size": total_size,
+                "etag": info["etag"],
+                "last_modified": info["last_modified"],
+                "segments": [
+                    [start, min(start + self.download_segment_size, total_size) - 1, 0]
+                    for start in range(0, total_size, self.download_segment_size)
+                ]
+            }
+            
+            # Preallocate so every connection can write at its own offset
+            fd = os.open(file_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+            try:
+                await asyncio.get_running_loop().run_in_executor(None, preallocate, fd, total_size)
+            finally:
+                os.close(fd)
+        
+        pending = [segment for segment in state["segments"] if segment[2] < segment[1] - segment[0] + 1]
+        connections = min(self.download_connections, len(pending)) or 1
+        logger.info(f"Downloading {movie_name}: {len(pending)} of {len(state['segments'])} segments over {connections} connections")
+        
+        queue = asyncio.Queue()
+        for segment in pending:
+            queue.put_nowait(segment)
+        progress = {"downloaded": sum(done for _, _, done in state["segments"])}
+        
+        # One descriptor for all connections, each writes at its own offsets
+        fd = os.open(file_path, os.O_WRONLY)
+        
+        async def worker():
+            while not queue.empty():
+                segment = queue.get_nowait()
+                await self.download_range(session, url, fd, segment, info["etag"], movie_name, total_size, progress, hasher)
+        
+        async def checkpoint():
+            saves = 0
+            while True:
+                await asyncio.sleep(STATE_SAVE_INTERVAL)
+                saves += 1
+                await self.save_download_state(file_path, movie_id, state, save_to_db=saves % STATE_DB_SAVE_EVERY == 0)
+        
+        workers = [asyncio.create_task(worker()) for _ in range(connections)]
+        checkpointer = asyncio.create_task(checkpoint())
         try:
-            logger.info(f"Starting download: {movie_name}")
+            await asyncio.gather(*workers)
+        except BaseException:
+            # Keep the partial file and record how far each segment got
+            await self.save_download_state(file_path, movie_id, state)
+            raise
+        finally:
+            # One failed range fails the whole download, stop the other connections
+            for task in workers + [checkpointer]:
+                task.cancel()
+            await asyncio.gather(*workers, checkpointer, return_exceptions=True)
+            os.close(fd)
+        
+        await self.clear_download_state(file_path, movie_id)
+    
+    async def download_range(self, session, url, fd, segment, etag, movie_name, total_size, progress, hasher=None):
+        """Download the rest of segment [start, end, done] of url into fd at the same offset.
+        
+        A stalled connection is dropped and the range continues on a fresh one
+        from the byte it had reached.
+        """
+        for restart in range(self.stall_restarts + 1):
+            try:
+                return await self.fetch_range(session, url, fd, segment, etag, movie_name, total_size, progress, hasher)
+            except DownloadStalled as e:
+                if restart == self.stall_restarts:
+                    raise
+                start, end, done = segment
+                logger.warning(f"Range {start}-{end} of {movie_name} stalled ({str(e)}), reconnecting at byte {start + done}")
+    
+    async def fetch_range(self, session, url, fd, segment, etag, movie_name, total_size, progress, hasher=None):
+        """Download the rest of segment [start, end, done] over one range request"""
+        start, end, done = segment
+        headers = {"Range": f"bytes={start + done}-{end}"}
+        if etag:
+            headers["If-Range"] = etag  # Full 200 response instead of mixed content if the file changed
+        
+        async with session.get(url, headers=headers) as response:
+            if response.status in (200, 416):
+                # The server ignored the range, or the file no longer covers it
+                raise RangesNotSupported(f"HTTP {response.status} for range request")
+            if response.status != 206:
+                raise HTTPStatusError(response.status)
+            # Without an ETag, If-Range can't catch a changed file; its size still can
+            content_range = response.headers.get('content-range', '')
+            if content_range.rsplit('/', 1)[-1] not in ('*', str(total_size)):
+                raise RangesNotSupported(f"file size changed to {content_range.rsplit('/', 1)[-1]} bytes")
             
-            async with aiohttp.ClientSession() as session:
-                async with session.get(url) as response:
-                    if response.status == 200:
-                        total_size = int(response.headers.get('content-length', 0))
-                        downloaded = 0
-                        
-                        async with aiofiles.open(file_path, 'wb') as file:
-                            async for chunk in response.content.iter_chunked(8192):
-                                await file.write(chunk)
-                                downloaded += len(chunk)
-                                
-                                if total_size > 0:
-                                    progress = (downloaded / total_size) * 100
-                                    if downloaded % (1024 * 1024 * 50) == 0:  # Log every 50MB
-                                        logger.info(f"Download progress for {movie_name}: {progress:.1f}%")
-                        
-                        logger.info(f"Download completed: {movie_name}")
-                        return True
-                    else:
-                        logger.error(f"Failed to download {movie_name}: HTTP {response.status}")
-                        return False
-                        
-        except Exception as e:
-            logger.error(f"Error downloading {movie_name}: {str(e)}")
-            return False
+            writer = BufferedFileWriter(fd, start + done, self.write_buffer_size)
+            feeder = hasher.feeder(start + done) if hasher else None
+            try:
+                async for chunk in self.iter_monitored(response):
+                    await writer.write(chunk)
+                    if feeder:
+                        await feeder.feed(chunk)
+                    segment[2] = done + writer.written
+                    previous = progress["downloaded"]
+                    progress["downloaded"] += len(chunk)
+                    self.log_download_progress(movie_name, previous, progress["downloaded"], total_size)
+            finally:
+                # Keep what arrived before a stall, the restart continues after it
+                await writer.flush()
+                segment[2] = done + writer.written
+            
+            if segment[2] != end - start + 1:
+                raise IOError(f"Range {start}-{end} ended after {segment[2]} bytes")
+            if feeder:
+                await feeder.close(at_eof=end + 1 == total_size)
     
     async def split_file(self, file_path, movie_name):
-        """Split large file into smaller chunks"""
+        """Split large file into (path, offset, length) slices without copying any bytes"""
         try:
             file_size = os.path.getsize(file_path)
+            ranges = self.part_ranges(file_size)
             
-            if file_size <= self.max_file_size_bytes:
+            if len(ranges) == 1:
                 return [file_path]  # No need to split
             
-            logger.info(f"Splitting large file ({file_size / (1024*1024):.1f}MB): {movie_name}")
-            
-            # Calculate number of parts needed
-            num_parts = math.ceil(file_size / self.max_file_size_bytes)
-            part_size = math.ceil(file_size / num_parts)
-            
-            base_name = os.path.splitext(file_path)[0]
-            split_files = []
-            
-            async with aiofiles.open(file_path, 'rb') as source_file:
-                for part_num in range(num_parts):
-                    part_filename = f"{base_name}.{part_num + 1:03d}.mp4"
-                    split_files.append(part_filename)
-                    
-                    async with aiofiles.open(part_filename, 'wb') as part_file:
-                        bytes_to_read = min(part_size, file_size - (part_num * part_size))
-                        bytes_read = 0
-                        
-                        while bytes_read < bytes_to_read:
-                            chunk_size = min(8192, bytes_to_read - bytes_read)
-                            chunk = await source_file.read(chunk_size)
-                            if not chunk:
-                                break
-                            await part_file.write(chunk)
-                            bytes_read += len(chunk)
-                    
-                    logger.info(f"Created part {part_num + 1}/{num_parts}: {part_filename}")
-            
-            # Remove original file after splitting
-            os.remove(file_path)
-            logger.info(f"Split complete: {num_parts} parts created")
-            
-            return split_files
+            logger.info(f"Splitting large file ({file_size / (1024*1024):.1f}MB) into {len(ranges)} slices: {movie_name}")
+            return [(file_path, offset, length) for offset, length in ranges]
             
         except Exception as e:
             logger.error(f"Error splitting file {file_path}: {str(e)}")
             return [file_path]  # Return original file if splitting fails
     
-    async def upload_to_telegram(self, file_path, caption, part_info=""):
-        """Upload file to Telegram group"""
-        try:
-            full_caption = f"{caption}{part_info}" if part_info else caption
-            logger.info(f"Uploading to Telegram: {full_caption}")
-            
-            message = await self.app.send_video(
-                chat_id=self.group_id,
-                video=file_path,
-                caption=full_caption,
-                supports_streaming=True
-            )
+    def part_name(self, file_path, part_num, total_parts):
+        """File name shown in Telegram for one part of a movie"""
+        base_name = os.path.splitext(os.path.basename(file_path))[0]
+        return f"{base_name}.{part_num:03d}.mp4" if total_parts > 1 else f"{base_name}.mp4"
+    
+    def part_names(self, file_parts):
+        """File names for a list of paths, (path, offset, length) slices or in-memory parts"""
+        return [
+            self.part_name(part[0], i, len(file_parts)) if isinstance(part, tuple)
+            else part.name if isinstance(part, MemoryPart) else part
+            for i, part in enumerate(file_parts, 1)
+        ]
+    
+    def open_part(self, part, file_name):
+        """Open one upload part for reading: the whole file, a window over a slice, or an in-memory movie"""
+        if isinstance(part, MemoryPart):
+            return part.open()
+        if isinstance(part, tuple):
+            # Upload the byte range straight from the original file
+            path, offset, length = part
+            return FileSlice(path, offset, length, name=file_name)
+        return open(part, 'rb')
+    
+    async def save_part_to_telegram(self, part, file_name, file_id=None, file_part=None):
+        """Upload one part's bytes to Telegram without sending it, retrying only this part on failure.
+        
+        With file_id and file_part, only that 512 KB chunk of an earlier upload
+        is sent again, for when Telegram reports it missing; that raises if it
+        can't be sent, the whole part upload returns None.
+        """
+        for attempt in range(1, PART_UPLOAD_ATTEMPTS + 1):
+            video = self.open_part(part, file_name)
+            try:
+                if file_id is not None:
+                    await self.resave_file_part(video, file_id, file_part)
+                    return None
+                return await self.save_file_to_telegram(video, file_name)
+            except Exception as e:
+                error = str(e)
+            finally:
+                video.close()
             
-            logger.info(f"Successfully uploaded to Telegram: {full_caption}")
-            return message.id
+            logger.warning(f"Upload attempt {attempt}/{PART_UPLOAD_ATTEMPTS} of {file_name} failed: {error}")
+            if attempt < PART_UPLOAD_ATTEMPTS:
+                await asyncio.sleep(2 ** attempt)
+        
+        if file_id is not None:
+            raise IOError(f"Re-upload of chunk {file_part} of {file_name} failed: {error}")
+        return None
+    
+    async def rate_limited(self, send, caption):
+        """Run a send to the group through the shared rate limiter, waiting out FloodWait instead of failing"""
+        flood_waits = 0
+        while True:
+            await self.rate_limiter.acquire()
+            try:
+                result = await send()
+            except FloodWait as e:
+                flood_waits += 1
+                if flood_waits > MAX_FLOOD_WAITS:
+                    raise
+                logger.warning(f"Telegram FloodWait of {e.value}s while sending {caption}, retrying the same part")
+                self.rate_limiter.on_flood_wait(e.value)
+                continue
             
-        except Exception as e:
-            logger.error(f"Error uploading to Telegram {caption}: {str(e)}")
-            return None
+            self.rate_limiter.on_success()
+            return result
+    
+    async def send_with_rate_limit(self, input_file, file_name, caption, part=None):
+        """Send an uploaded video to the group, re-uploading any chunk Telegram reports missing"""
+        resaves = 0
+        while True:
+            try:
+                return await self.rate_limited(lambda: self.send_uploaded_video(input_file, file_name, caption), caption)
+            except FilePartMissing as e:
+                resaves += 1
+                if part is None or resaves > MAX_PART_RESAVES:
+                    raise
+                # Re-upload just the chunk Telegram lost
+                await self.save_part_to_telegram(part, file_name, file_id=input_file.id, file_part=e.value)
+    
+    def media_file_id(self, message):
+        """Telegram file_id of the video (or document) in a sent message"""
+        media = message.video or message.document
+        return media.file_id if media else None
+    
+    async def resend_uploaded_media(self, record, movie_name):
+        """Post media that is already on Telegram again for another movie, without uploading it"""
+        file_ids = record.get("file_ids") or []
+        message_ids = record.get("message_ids") or []
+        total_parts = len(file_ids) or len(message_ids)
+        messages = []
+        
+        for i in range(total_parts):
+            caption = f"{movie_name} [Part {i + 1}/{total_parts}]" if total_parts > 1 else movie_name
+            if file_ids:
+                send = functools.partial(self.app.send_cached_media, self.group_id, file_ids[i], caption=caption)
+            else:
+                # Older records only know the message, copy it with the new caption
+                send = functools.partial(self.app.copy_message, self.group_id, self.group_id, message_ids[i], caption=caption)
+            messages.append(await self.rate_limited(send, caption))
+        
+        return messages
     
     async def upload_files_to_telegram(self, file_paths, movie_name):
-        """Upload single or multiple files to Telegram"""
-        message_ids = []
-        
-        if len(file_paths) == 1:
-            # Single file upload
-            message_id = await self.upload_to_telegram(file_paths[0], movie_name)
-            if message_id:
-                message_ids.append(message_id)
+        """Upload single or multiple files (paths or (path, offset, length) slices) to Telegram.
+        
+        Parts are uploaded concurrently, up to part_upload_concurrency per movie over
+        the part uploader's shared connections, then sent to the group in order.
+        Returns the sent messages, or an empty list if any part failed to upload;
+        errors while sending (such as repeated FloodWait) are raised.
+        """
+        total_parts = len(file_paths)
+        file_names = [os.path.basename(name) for name in self.part_names(file_paths)]
+        captions = [
+            f"{movie_name} [Part {i}/{total_parts}]" if total_parts > 1 else movie_name
+            for i in range(1, total_parts + 1)
+        ]
+        semaphore = asyncio.Semaphore(self.part_upload_concurrency)
+        
+        async def upload_part(index):
+            async with semaphore:
+                logger.info(f"Uploading to Telegram: {captions[index]}")
+                return await self.save_part_to_telegram(file_paths[index], file_names[index])
+        
+        input_files = await asyncio.gather(*[upload_part(index) for index in range(total_parts)])
+        if any(input_file is None for input_file in input_files):
+            # If any part fails, consider the whole upload failed
+            logger.error(f"Error uploading to Telegram {movie_name}: a part failed after {PART_UPLOAD_ATTEMPTS} attempts")
+            return []
+        
+        # Send in part order so the group reads Part 1, Part 2, ...
+        messages = []
+        for index, input_file in enumerate(input_files):
+            try:
+                message = await self.send_with_rate_limit(input_file, file_names[index], captions[index], file_paths[index])
+            except Exception as e:
+                logger.error(f"Error sending to Telegram {captions[index]}: {str(e)}")
+                raise
+            if not message:
+                return []
+            
+            messages.append(message)
+            logger.info(f"Successfully uploaded to Telegram: {captions[index]}")
+        
+        return messages
+    
+    def part_ranges(self, file_size):
+        """Return (offset, length) byte ranges for each Telegram upload of a file"""
+        if file_size <= self.max_file_size_bytes:
+            return [(0, file_size)]
+        
+        num_parts = math.ceil(file_size / self.max_file_size_bytes)
+        part_size = math.ceil(file_size / num_parts)
+        return [(offset, min(part_size, file_size - offset)) for offset in range(0, file_size, part_size)]
+    
+    def file_part_request(self, file_id, file_part, file_size, chunk):
+        """The upload request for one 512 KB chunk of a file of file_size bytes"""
+        if file_size > TELEGRAM_BIG_FILE_THRESHOLD:
+            return raw.functions.upload.SaveBigFilePart(
+                file_id=file_id,
+                file_part=file_part,
+                file_total_parts=math.ceil(file_size / TELEGRAM_PART_SIZE),
+                bytes=chunk
+            )
+        return raw.functions.upload.SaveFilePart(
+            file_id=file_id,
+            file_part=file_part,
+            bytes=chunk
+        )
+    
+    async def save_parts_to_telegram(self, read, file_size, file_name, feeder=None):
+        """Upload file_size bytes, read in order with `await read(size)`, as one Telegram file.
+        
+        Reading stays one part ahead of the bounded part_uploader queue, so the
+        chunks in memory are limited however fast the source is.
+        """
+        is_big = file_size > TELEGRAM_BIG_FILE_THRESHOLD
+        file_total_parts = math.ceil(file_size / TELEGRAM_PART_SIZE)
+        file_id = self.app.rnd_id()
+        md5_sum = md5() if not is_big else None
+        errors = []
+        futures = []
+        
+        remaining = file_size
+        for file_part in range(file_total_parts):
+            chunk = await read(min(TELEGRAM_PART_SIZE, remaining))
+            remaining -= len(chunk)
+            if feeder:
+                await feeder.feed(chunk)
+            
+            if errors:
+                break  # The upload is already lost
+            
+            if not is_big:
+                md5_sum.update(chunk)
+            futures.append(await self.part_uploader.put(self.file_part_request(file_id, file_part, file_size, chunk), errors))
+        
+        await asyncio.gather(*futures)
+        if errors:
+            raise errors[0]
+        
+        if is_big:
+            return raw.types.InputFileBig(id=file_id, parts=file_total_parts, name=file_name)
+        return raw.types.InputFile(id=file_id, parts=file_total_parts, name=file_name, md5_checksum=md5_sum.hexdigest())
+    
+    async def save_file_to_telegram(self, video, file_name):
+        """Upload an open file (or FileSlice) through the part uploader"""
+        file_size = video.seek(0, os.SEEK_END)
+        video.seek(0)
+        
+        if isinstance(video, io.BytesIO):
+            # Already in memory, no need for a thread
+            async def read(size):
+                return video.read(size)
         else:
-            # Multiple parts upload
-            for i, file_path in enumerate(file_paths, 1):
-                part_info = f" [Part {i}/{len(file_paths)}]"
-                message_id = await self.upload_to_telegram(file_path, movie_name, part_info)
-                if message_id:
-                    message_ids.append(message_id)
-                else:
-                    # If any part fails, consider the whole upload failed
-                    return []
-                    
-                # Small delay between uploads to avoid rate limiting
-                if i < len(file_paths):
-                    await asyncio.sleep(3)  # Increased delay for GitHub Actions
+            loop = asyncio.get_running_loop()
+            read = lambda size: loop.run_in_executor(None, video.read, size)
+        
+        return await self.save_parts_to_telegram(read, file_size, file_name)
+    
+    async def resave_file_part(self, video, file_id, file_part):
+        """Upload one chunk of an earlier upload again"""
+        file_size = video.seek(0, os.SEEK_END)
+        video.seek(file_part * TELEGRAM_PART_SIZE)
+        chunk = video.read(TELEGRAM_PART_SIZE)
         
-        return message_ids
+        errors = []
+        await (await self.part_uploader.put(self.file_part_request(file_id, file_part, file_size, chunk), errors))
+        if errors:
+            raise errors[0]
+    
+    async def send_uploaded_video(self, input_file, file_name, caption):
+        """Send an already uploaded InputFile to the Telegram group as a streamable video"""
+        media = raw.types.InputMediaUploadedDocument(
+            mime_type="video/mp4",
+            file=input_file,
+            attributes=[
+                raw.types.DocumentAttributeVideo(supports_streaming=True, duration=0, w=0, h=0),
+                raw.types.DocumentAttributeFilename(file_name=file_name)
+            ]
+        )
+        
+        r = await self.app.invoke(
+            raw.functions.messages.SendMedia(
+                peer=await self.app.resolve_peer(self.group_id),
+                media=media,
+                random_id=self.app.rnd_id(),
+                **await utils.parse_text_entities(self.app, caption, None, None)
+            )
+        )
+        
+        for update in r.updates:
+            if isinstance(update, (raw.types.UpdateNewMessage, raw.types.UpdateNewChannelMessage)):
+                return await types.Message._parse(
+                    self.app, update.message,
+                    {user.id: user for user in r.users},
+                    {chat.id: chat for chat in r.chats}
+                )
+        return None
+    
+    async def stream_movie_to_telegram(self, url, file_path, movie_name):
+        """Upload a movie to Telegram while it is still downloading, without writing it to disk.
+        
+        Returns (messages, part_names, content_hash), or None if the source can't be
+        streamed (no Content-Length) and the regular download path should be used instead.
+        Raises if the download or upload fails part way.
+        """
+        try:
+            session = await self.get_http_session()
+            async with session.get(url) as response:
+                if response.status != 200:
+                    raise HTTPStatusError(response.status)
+                
+                total_size = int(response.headers.get('content-length', 0))
+                if total_size <= 0:
+                    logger.info(f"No Content-Length for {movie_name}, falling back to disk download")
+                    return None
+                
+                ranges = self.part_ranges(total_size)
+                is_split = len(ranges) > 1
+                messages = []
+                part_names = []
+                hasher = ContentHasher(self.hash_executor)
+                feeder = hasher.feeder(0)
+                
+                logger.info(f"Streaming {movie_name} ({total_size / (1024*1024):.1f}MB) to Telegram in {len(ranges)} part(s)")
+                read = self.monitored_reader(response)
+                
+                for i, (offset, length) in enumerate(ranges, 1):
+                    part_name = self.part_name(file_path, i, len(ranges))
+                    caption = f"{movie_name} [Part {i}/{len(ranges)}]" if is_split else movie_name
+                    
+                    input_file = await self.save_parts_to_telegram(read, length, part_name, feeder)
+                    message = await self.send_with_rate_limit(input_file, part_name, caption)
+                    if not message:
+                        logger.error(f"Telegram did not return a message for {caption}")
+                        return [], part_names, None
+                    
+                    messages.append(message)
+                    part_names.append(part_name)
+                    logger.info(f"Successfully streamed to Telegram: {caption}")
+                
+                await feeder.close(at_eof=True)
+                return messages, part_names, await hasher.finalize(None, total_size)
+                
+        except Exception as e:
+            logger.error(f"Error streaming {movie_name} to Telegram: {str(e)}")
+            raise
     
-    def cleanup_files(self, file_paths):
-        """Delete downloaded files after upload"""
-        if isinstance(file_paths, str):
+    def cleanup_files(self, file_paths, keep_cached=False):
+        """Delete downloaded files after upload; with keep_cached, files in the download cache stay for the next attempt"""
+        if isinstance(file_paths, (str, tuple)):
             file_paths = [file_paths]
+        
+        # In-memory movies only hand back their share of the memory budget
+        for part in file_paths:
+            if isinstance(part, MemoryPart):
+                self.memory_budget.release(part.reserved)
+        file_paths = [part for part in file_paths if not isinstance(part, MemoryPart)]
+        
+        # Slices all point back to the original file
+        file_paths = list(dict.fromkeys(part[0] if isinstance(part, tuple) else part for part in file_paths))
             
         for file_path in file_paths:
+            self.disk_budget.release(file_path)
             try:
+                if self.download_cache and self.download_cache.owns(file_path):
+                    self.download_cache.done(file_path, keep=keep_cached)
+                    continue
                 if os.path.exists(file_path):
                     os.remove(file_path)
                     logger.info(f"Cleaned up file: {file_path}")
+                if os.path.exists(self.download_state_path(file_path)):
+                    os.remove(self.download_state_path(file_path))
             except Exception as e:
                 logger.error(f"Error cleaning up file {file_path}: {str(e)}")
     
-    async def process_movie(self, movie_data):
+    async def process_movie(self, movie_data, check_uploaded=True):
         """Process a single movie: download and upload"""
+        while True:
+            job = await self.download_stage(movie_data, check_uploaded)
+            if not isinstance(job, dict):
+                return job
+            movie_data = await self.upload_stage(job)
+            if not isinstance(movie_data, dict):
+                return movie_data
+            check_uploaded = False
+    
+    async def download_stage(self, movie_data, check_uploaded=True):
+        """First pipeline stage: download a movie and plan its upload parts.
+        
+        Returns a job dict for upload_stage, True/False when the movie is
+        already finished (skipped or failed) and there is nothing to upload,
+        or None when it was left alone: claimed by another runner, or too big
+        for the time left in a time-budget run. Entries sent back by
+        upload_stage carry allow_stream/allow_reuse set to False, and claimed,
+        as this runner already holds their lease.
+        """
         movie_id = movie_data["id"]
         movie_name = movie_data["name"]
         movie_url = movie_data["link"]
         
-        # Check if already uploaded
-        if self.is_already_uploaded(movie_id):
+        # Check if already uploaded (process_all_movies filters the catalog up front instead)
+        if check_uploaded and await self.run_db(self.is_already_uploaded, movie_id):
             logger.info(f"Skipping already uploaded movie: {movie_name}")
             return True
         
+        # Take the lease, so no other runner works on the same movie
+        if not movie_data.get("claimed") and not await self.run_db(self.claim_movie, movie_id, movie_name):
+            logger.info(f"Skipping {movie_name}: uploaded or already in progress")
+            return None
+        
         # Generate file path
         safe_filename = "".join(c for c in movie_name if c.isalnum() or c in (' ', '-', '_', '.')).rstrip()
         file_path = os.path.join(self.downloads_dir, f"{movie_id}_{safe_filename}.mp4")
         
+        job = {
+            "movie_id": movie_id,
+            "movie_name": movie_name,
+            "movie_url": movie_url,
+            "file_path": file_path,
+            "files_to_upload": None,
+            "content_hash": None,
+            "source_meta": None,
+            "duplicate": None,
+            "size": 0,
+            "stream": self.stream_uploads and movie_data.get("allow_stream", True)
+        }
+        
         try:
-            # Download file
-            if await self.download_file(movie_url, file_path, movie_name):
-                # Check if file needs splitting
-                file_size = os.path.getsize(file_path)
-                logger.info(f"Downloaded file size: {file_size / (1024*1024):.1f}MB")
+            # One HEAD up front: dead links fail here, known files are reused without downloading
+            # Probes from the plan or the cache may be old, the download checks those again
+            if movie_data.get("info"):
+                info, fresh_info = movie_data["info"], False
+            else:
+                info, fresh_info = await self.get_probe(movie_url)
+            if info and info["status"] in DEAD_LINK_STATUSES:
+                logger.error(f"Dead link for {movie_name}: HTTP {info['status']}")
+                await self.run_db(self.mark_as_failed, movie_id, movie_name, f"Dead link: HTTP {info['status']}", FAILURE_PERMANENT_HTTP)
+                return False
+            
+            job["source_meta"] = self.source_metadata(movie_url, info)
+            if movie_data.get("allow_reuse", True):
+                job["duplicate"] = await self.run_db(self.find_uploaded_by_source, job["source_meta"], movie_id)
+            if job["duplicate"]:
+                logger.info(f"{movie_name} points to the same file as {job['duplicate'].get('movie_name')}, skipping download")
+                return job
+            
+            # Only start what can still finish within the time budget
+            job["size"] = info["size"] if info and info["size"] else self.disk_default_reservation
+            if self.time_budget and not self.time_budget.admits(job["size"]):
+                logger.info(f"Deferring {movie_name}: about {self.time_budget.estimate(job['size']) / 60:.0f} min needed, {self.time_budget.remaining() / 60:.0f} min left")
+                await self.run_db(self.release_lease, movie_id)
+                return None
+            
+            # A download kept from an earlier attempt needs no new one
+            if self.download_cache:
+                cached = self.download_cache.lookup(job["source_meta"]["source_url"], info and info["size"], info and info["etag"])
+                if cached:
+                    job["content_hash"], file_path = cached
+                    logger.info(f"Using cached download of {movie_name}: {file_path}")
+                    job["file_path"] = file_path
+                    job["stream"] = False
+                    job["files_to_upload"] = await self.split_file(file_path, movie_name)
+                    return job
+            
+            # Small movies are kept in memory when the budget has room, skipping the disk entirely
+            if info and 0 < info["size"] <= self.memory_file_threshold and self.memory_budget.try_reserve(info["size"]):
+                hasher = ContentHasher(self.hash_executor)
+                started = time.monotonic()
+                try:
+                    data = await self.download_to_memory(movie_url, movie_name, info["size"], hasher)
+                except SizeChanged as e:
+                    # The probe is out of date; the disk path HEADs the link again and takes any size
+                    logger.warning(f"{str(e)}, downloading to disk instead")
+                    self.memory_budget.release(info["size"])
+                    info, fresh_info = None, False
+                    job["size"] = self.disk_default_reservation
+                    data = None
+                except Exception as e:
+                    logger.error(f"Error downloading {movie_name}: {str(e)}")
+                    self.memory_budget.release(info["size"])
+                    await self.run_db(
+                        self.mark_as_failed, movie_id, movie_name, f"Failed to download: {str(e)}",
+                        self.classify_failure(e), movie_url
+                    )
+                    return False
                 
-                # Split file if necessary
-                files_to_upload = await self.split_file(file_path, movie_name)
+                if data is not None:
+                    logger.info(f"Downloaded {movie_name} into memory ({len(data) / (1024*1024):.1f}MB)")
+                    job["size"] = len(data)
+                    if self.time_budget:
+                        self.time_budget.download_rate.update(len(data), time.monotonic() - started)
+                    job["content_hash"] = await hasher.finalize(None, len(data))
+                    job["stream"] = False
+                    job["files_to_upload"] = [MemoryPart(file_path, data, info["size"])]
+                    return job
+            
+            # Streaming jobs download while they upload, so they run entirely in the upload stage
+            if job["stream"]:
+                return job
+            
+            # Reserve disk space up front, holding the download while the disk is full
+            await self.disk_budget.reserve(file_path, job["size"])
+            
+            # Download file, hashing it on the side for duplicate detection
+            hasher = ContentHasher(self.hash_executor)
+            started = time.monotonic()
+            try:
+                await self.download_file(movie_url, file_path, movie_name, movie_id, hasher, info if fresh_info else None)
+            except Exception as e:
+                # The partial file stays for resuming if there will be another attempt;
+                # the free space check accounts for it from now on
+                logger.error(f"Error downloading {movie_name}: {str(e)}")
+                self.disk_budget.release(file_path)
+                retrying = await self.run_db(
+                    self.mark_as_failed, movie_id, movie_name, f"Failed to download: {str(e)}",
+                    self.classify_failure(e), movie_url
+                )
+                if not retrying:
+                    await self.discard_partial_download(file_path, movie_id)
+                return False
+            
+            # Check if file needs splitting
+            file_size = os.path.getsize(file_path)
+            logger.info(f"Downloaded file size: {file_size / (1024*1024):.1f}MB")
+            job["size"] = file_size
+            if self.time_budget:
+                self.time_budget.download_rate.update(file_size, time.monotonic() - started)
+            job["content_hash"] = await hasher.finalize(file_path, file_size)
+            
+            # Keep the file in the download cache until its upload is confirmed
+            if self.download_cache and job["content_hash"]:
+                self.disk_budget.release(file_path)
+                file_path = await self.download_cache.add(file_path, job["content_hash"], job["source_meta"]["source_url"], info and info["etag"])
+                job["file_path"] = file_path
+            
+            # Split file if necessary
+            job["files_to_upload"] = await self.split_file(file_path, movie_name)
+            return job
                 
-                # Upload to Telegram
-                message_ids = await self.upload_files_to_telegram(files_to_upload, movie_name)
+        except Exception as e:
+            error_msg = f"Unexpected error: {str(e)}"
+            await self.run_db(self.mark_as_failed, movie_id, movie_name, error_msg, self.classify_failure(e), movie_url)
+            
+            # Cleanup any remaining files
+            self.disk_budget.release(file_path)
+            if os.path.exists(file_path):
+                self.cleanup_files(file_path, keep_cached=True)
+            
+            logger.error(f"Error processing {movie_name}: {error_msg}")
+            return False
+    
+    async def reuse_duplicate(self, job, duplicate):
+        """Post an earlier movie's media for this job instead of uploading it again"""
+        movie_name = job["movie_name"]
+        try:
+            messages = await self.resend_uploaded_media(duplicate, movie_name)
+            await self.run_db(
+                self.mark_as_uploaded,
+                job["movie_id"], movie_name, duplicate.get("file_paths", []), [message.id for message in messages],
+                duplicate.get("is_split", False), duplicate.get("total_parts", len(messages)),
+                content_hash=job["content_hash"] or duplicate.get("content_hash"),
+                file_ids=[self.media_file_id(message) for message in messages],
+                reused_from=duplicate["movie_id"], source_meta=job["source_meta"]
+            )
+            logger.info(f"Successfully processed: {movie_name} (same file as {duplicate.get('movie_name')}, reused its upload)")
+            
+            if job["files_to_upload"]:
+                self.cleanup_files(job["files_to_upload"])
+            return True
+            
+        except Exception as e:
+            logger.warning(f"Could not reuse upload of {duplicate.get('movie_name')} for {movie_name}: {str(e)}")
+            return False
+    
+    async def upload_stage(self, job):
+        """Second pipeline stage: upload a downloaded (or streamed) movie to Telegram.
+        
+        Returns True/False like download_stage, or a catalog entry to send back
+        to the download stage when the movie has to be downloaded after all.
+        """
+        movie_id = job["movie_id"]
+        movie_name = job["movie_name"]
+        file_path = job["file_path"]
+        movie_data = {"id": movie_id, "name": movie_name, "link": job["movie_url"]}
+        
+        try:
+            # Stream straight to Telegram when enabled and the source allows it
+            if job["stream"] and not job["duplicate"]:
+                started = time.monotonic()
+                streamed = await self.stream_movie_to_telegram(job["movie_url"], file_path, movie_name)
+                if streamed is not None:
+                    messages, part_names, content_hash = streamed
+                    if messages:
+                        if self.time_budget:
+                            self.time_budget.upload_rate.update(job["size"], time.monotonic() - started)
+                        is_split = len(part_names) > 1
+                        await self.run_db(
+                            self.mark_as_uploaded,
+                            movie_id, movie_name, part_names, [message.id for message in messages], is_split, len(part_names),
+                            content_hash=content_hash, file_ids=[self.media_file_id(message) for message in messages],
+                            source_meta=job["source_meta"]
+                        )
+                        logger.info(f"Successfully processed: {movie_name} (streamed{', split into ' + str(len(part_names)) + ' parts' if is_split else ''})")
+                        return True
+                    else:
+                        await self.run_db(self.mark_as_failed, movie_id, movie_name, "Failed to stream to Telegram", movie_url=job["movie_url"])
+                        return False
                 
-                if message_ids:
-                    # Mark as uploaded in database
-                    is_split = len(files_to_upload) > 1
-                    self.mark_as_uploaded(
-                        movie_id, 
-                        movie_name, 
-                        files_to_upload, 
-                        message_ids, 
-                        is_split, 
-                        len(files_to_upload)
-                    )
-                    logger.info(f"Successfully processed: {movie_name} ({'split into ' + str(len(files_to_upload)) + ' parts' if is_split else 'single file'})")
-                    
-                    # Cleanup downloaded files
-                    self.cleanup_files(files_to_upload)
+                # Not streamable, so it goes back to the download workers
+                return dict(movie_data, allow_stream=False, claimed=True)
+            
+            # Same file already on Telegram under another movie? Resend that media instead
+            duplicate = job["duplicate"]
+            if not duplicate and job["content_hash"]:
+                duplicate = await self.run_db(self.find_uploaded_by_hash, job["content_hash"], movie_id)
+            if duplicate:
+                if await self.reuse_duplicate(job, duplicate):
                     return True
-                else:
-                    self.mark_as_failed(movie_id, movie_name, "Failed to upload to Telegram")
-                    self.cleanup_files(files_to_upload)
-                    return False
+                if job["files_to_upload"] is None:
+                    # Matched on URL metadata, so nothing has been downloaded yet
+                    return dict(movie_data, allow_stream=False, allow_reuse=False, claimed=True)
+            
+            files_to_upload = job["files_to_upload"]
+            
+            # Upload to Telegram
+            started = time.monotonic()
+            messages = await self.upload_files_to_telegram(files_to_upload, movie_name)
+            if messages and self.time_budget:
+                self.time_budget.upload_rate.update(job["size"], time.monotonic() - started)
+            
+            if messages:
+                # Mark as uploaded in database
+                is_split = len(files_to_upload) > 1
+                await self.run_db(
+                    self.mark_as_uploaded,
+                    movie_id, 
+                    movie_name, 
+                    self.part_names(files_to_upload), 
+                    [message.id for message in messages], 
+                    is_split, 
+                    len(files_to_upload),
+                    content_hash=job["content_hash"],
+                    file_ids=[self.media_file_id(message) for message in messages],
+                    source_meta=job["source_meta"]
+                )
+                logger.info(f"Successfully processed: {movie_name} ({'split into ' + str(len(files_to_upload)) + ' parts' if is_split else 'single file'})")
+                
+                # Cleanup downloaded files
+                self.cleanup_files(files_to_upload)
+                return True
             else:
-                self.mark_as_failed(movie_id, movie_name, "Failed to download")
+                await self.run_db(
+                    self.mark_as_failed, movie_id, movie_name, "Failed to upload to Telegram",
+                    FAILURE_TRANSIENT_NETWORK, job["movie_url"]
+                )
+                self.cleanup_files(files_to_upload, keep_cached=True)
                 return False
                 
         except Exception as e:
             error_msg = f"Unexpected error: {str(e)}"
-            self.mark_as_failed(movie_id, movie_name, error_msg)
+            await self.run_db(
+                self.mark_as_failed, movie_id, movie_name, error_msg, self.classify_failure(e), job["movie_url"],
+                retry_after=e.value if isinstance(e, FloodWait) else None
+            )
             
             # Cleanup any remaining files
-            if os.path.exists(file_path):
-                self.cleanup_files(file_path)
+            self.disk_budget.release(job["file_path"])
+            if job["files_to_upload"] or os.path.exists(job["file_path"]):
+                self.cleanup_files(job["files_to_upload"] or job["file_path"], keep_cached=True)
             
             logger.error(f"Error processing {movie_name}: {error_msg}")
             return False
     
-    async def process_all_movies(self, json_source, max_concurrent=2):
-        """Process all movies from JSON file or Google Drive URL"""
+    async def iter_pending_movies(self, movies, catalog_stats):
+        """Drop uploaded, permanently failed and queued-for-retry entries from a stream of catalog entries.
+        
+        Entries are checked against MongoDB in batches, so uploads can start
+        after the first batch instead of after the whole catalog is read.
+        """
+        async def filter_batch(batch):
+            settled = await self.run_db(self.load_settled_ids, [movie["id"] for movie in batch])
+            for status in settled.values():
+                catalog_stats["skipped" if status == "uploaded" else "not_retried"] += 1
+            return [movie for movie in batch if movie["id"] not in settled]
+        
+        batch = []
+        async for movie_data in movies:
+            catalog_stats["loaded"] += 1
+            batch.append(movie_data)
+            
+            if len(batch) >= CATALOG_BATCH:
+                for movie in await filter_batch(batch):
+                    yield movie
+                batch = []
+        
+        if batch:
+            for movie in await filter_batch(batch):
+                yield movie
+    
+    async def iter_smallest_first(self, movies):
+        """Reorder entries smallest first within windows of SCHEDULE_WINDOW, so more finish in a time budget.
+        
+        Sizes come from the probe cache, or a parallel HEAD of each window; the
+        probe rides along in the entry as "info" so download_stage doesn't
+        repeat it. Entries of unknown size go last.
+        """
+        async def ordered(window):
+            await self.probe_movies(window)
+            return sorted(window, key=lambda movie_data: (movie_data["info"] or {}).get("size") or float("inf"))
+        
+        window = []
+        async for movie_data in movies:
+            window.append(movie_data)
+            if len(window) >= SCHEDULE_WINDOW:
+                for movie in await ordered(window):
+                    yield movie
+                window = []
+        
+        if window:
+            for movie in await ordered(window):
+                yield movie
+    
+    async def plan_catalog(self, movies, download_concurrency, upload_concurrency):
+        """Probe every pending entry up front and summarise what the run would transfer"""
+        plan = {"movies": 0, "cached": 0, "dead": 0, "unreachable": 0, "unknown_size": 0, "bytes": 0, "parts": 0}
+        started = time.monotonic()
+        
+        async def plan_batch(batch):
+            plan["cached"] += await self.probe_movies(batch)
+            for movie_data in batch:
+                info = movie_data["info"]
+                plan["movies"] += 1
+                if info is None:
+                    plan["unreachable"] += 1
+                elif info["status"] in DEAD_LINK_STATUSES:
+                    plan["dead"] += 1
+                elif not info["size"]:
+                    plan["unknown_size"] += 1
+                else:
+                    plan["bytes"] += info["size"]
+                    plan["parts"] += len(self.part_ranges(info["size"]))
+        
+        batch = []
+        async for movie_data in movies:
+            batch.append(movie_data)
+            if len(batch) >= CATALOG_BATCH:
+                await plan_batch(batch)
+                batch = []
+        if batch:
+            await plan_batch(batch)
+        
+        # Downloads and uploads overlap, so the slower side sets the pace
+        plan["estimated_seconds"] = max(
+            plan["bytes"] / (INITIAL_DOWNLOAD_RATE * download_concurrency),
+            plan["bytes"] / (INITIAL_UPLOAD_RATE * upload_concurrency)
+        )
+        plan["probe_seconds"] = time.monotonic() - started
+        return plan
+    
+    def log_plan(self, plan):
+        """Log the summary from plan_catalog"""
+        logger.info(
+            f"Plan: {plan['movies']} movies probed in {plan['probe_seconds']:.0f}s ({plan['cached']} from cache), "
+            f"{plan['bytes'] / 1024 ** 3:.1f}GB in {plan['parts']} Telegram parts, "
+            f"{plan['dead']} dead links, {plan['unreachable']} unreachable, {plan['unknown_size']} of unknown size, "
+            f"about {plan['estimated_seconds'] / 3600:.1f}h to transfer"
+        )
+    
+    async def iter_catalog_changes(self, movies, catalog_stats, catalog_source=None, validators=None):
+        """Yield new and changed catalog entries, and those still waiting from earlier runs.
+        
+        Stands in for iter_pending_movies when syncing incrementally. Once a
+        downloaded catalog has been read to the end, its validators are saved
+        for the next conditional fetch.
+        """
+        synced_at = datetime.now()
+        
+        async def diff_batch(batch):
+            work, counts = await self.run_db(self.diff_catalog_batch, batch, synced_at)
+            for key, value in counts.items():
+                catalog_stats[key] += value
+            return work
+        
+        batch = []
+        async for movie_data in movies:
+            catalog_stats["loaded"] += 1
+            batch.append(movie_data)
+            
+            if len(batch) >= CATALOG_BATCH:
+                for movie in await diff_batch(batch):
+                    yield movie
+                batch = []
+        
+        if batch:
+            for movie in await diff_batch(batch):
+                yield movie
+        
+        if validators is not None:
+            await self.run_db(self.finish_catalog_sync, catalog_source, validators, synced_at)
+    
+    async def iter_work(self, retries, movies):
+        """Yield due retries first, then the pending catalog entries"""
+        for movie_data in retries:
+            yield movie_data
+        async for movie_data in movies:
+            yield movie_data
+    
+    async def run_work_queue(self, movies, download_concurrency, upload_concurrency):
+        """Run movies through separate download and upload worker pools.
+        
+        A producer feeds a queue drained by download workers, which hand
+        finished downloads to upload workers through a bounded queue. When
+        uploads fall behind, the hand-off queue fills and downloads pause, so both
+        links stay busy without piling up files on disk. Movies the upload stage
+        finds it has to download after all go back to the download workers.
+        Results are counted as they finish, so memory stays flat regardless of
+        catalog size.
+        """
+        # Movies taken from the catalog and not finished yet: enough to fill every queue and worker
+        max_in_flight = download_concurrency * 3 + upload_concurrency * 2
+        in_flight = asyncio.Semaphore(max_in_flight)
+        download_queue = asyncio.Queue()
+        upload_queue = asyncio.Queue(maxsize=upload_concurrency)
+        results = {"successful": 0, "failed": 0, "not_started": 0}
+        
+        def record(success):
+            if success is None:
+                results["not_started"] += 1
+            else:
+                results["successful" if success is True else "failed"] += 1
+            in_flight.release()
+        
+        async def producer():
+            try:
+                async for movie_data in movies:
+                    if self.time_budget and self.time_budget.expired():
+                        logger.info("Time budget used up, finishing the movies in progress")
+                        break
+                    await in_flight.acquire()
+                    download_queue.put_nowait(movie_data)
+            except Exception as e:
+                # A broken catalog still lets the workers finish what they've claimed
+                logger.error(f"Error reading the catalog, finishing the movies in progress: {str(e)}")
+            
+            # Upload workers can still send movies back for downloading until every one has finished
+            for _ in range(max_in_flight):
+                await in_flight.acquire()
+            for _ in range(download_concurrency):
+                download_queue.put_nowait(None)  # One stop signal per worker
+        
+        async def download_worker():
+            while True:
+                movie_data = await download_queue.get()
+                if movie_data is None:
+                    return
+                
+                try:
+                    job = await self.download_stage(movie_data, check_uploaded=False)
+                except Exception as e:
+                    logger.error(f"Error downloading {movie_data.get('name')}: {str(e)}")
+                    job = False
+                
+                if isinstance(job, dict):
+                    await upload_queue.put(job)
+                else:
+                    record(job)
+        
+        async def upload_worker():
+            while True:
+                job = await upload_queue.get()
+                if job is None:
+                    return
+                
+                try:
+                    success = await self.upload_stage(job)
+                except Exception as e:
+                    logger.error(f"Error uploading {job['movie_name']}: {str(e)}")
+                    success = False
+                
+                if isinstance(success, dict):
+                    # Has to be downloaded first; the download workers take it from here
+                    download_queue.put_nowait(success)
+                else:
+                    record(success)
+        
+        async def downloads():
+            await asyncio.gather(producer(), *[download_worker() for _ in range(download_concurrency)])
+            for _ in range(upload_concurrency):
+                await upload_queue.put(None)
+        
+        await asyncio.gather(downloads(), *[upload_worker() for _ in range(upload_concurrency)])
+        return results
+    
+    async def process_all_movies(self, json_source, max_concurrent=2, download_concurrency=None, upload_concurrency=None, time_budget=None,
+                                 probe_first=False, plan_only=False, incremental_sync=True):
+        """Process all movies from JSON file or Google Drive URL.
+        
+        With time_budget (seconds), only movies expected to finish in time are
+        started, smallest first, and the run winds down before the budget ends.
+        With probe_first, every pending link is probed and a plan logged before
+        anything is transferred; plan_only stops after that.
+        With incremental_sync, the catalog is fetched conditionally and only
+        entries that are new, changed or still to do since the last sync are worked on.
+        """
+        download_concurrency = download_concurrency or max_concurrent
+        upload_concurrency = upload_concurrency or max_concurrent
+        if time_budget:
+            self.time_budget = TimeBudget(time_budget)
+        heartbeat = None
+        local_json_path = None
         try:
-            local_json_path = None
+            await self.run_db(self.ensure_indexes)
+            validators = await self.run_db(self.load_catalog_state, json_source) if incremental_sync else None
             
             # Check if json_source is a Google Drive URL or local file path
             if json_source.startswith('https://drive.google.com'):
-                # Download from Google Drive
-                local_json_path = await self.download_json_from_gdrive(json_source)
+                # Download from Google Drive, unless it hasn't changed since the last sync
+                local_json_path = await self.download_json_from_gdrive(json_source, validators=validators)
                 if not local_json_path:
                     logger.error("Failed to download JSON from Google Drive")
                     return
+                if local_json_path == CATALOG_NOT_MODIFIED:
+                    local_json_path = None
+                    validators = None
                 json_file_path = local_json_path
             else:
                 # Use as local file path
                 json_file_path = json_source
             
-            # Load JSON data
-            with open(json_file_path, 'r', encoding='utf-8') as file:
-                movies_data = json.load(file)
+            def catalog_entries():
+                # An unchanged catalog isn't downloaded; what's left to do comes from the snapshot
+                return self.iter_catalog(json_file_path) if json_file_path else self.iter_pending_snapshot()
             
-            logger.info(f"Loaded {len(movies_data)} movies from {json_file_path}")
+            # Probe the whole catalog first; the sizes stay cached for the run itself
+            if probe_first or plan_only:
+                plan_stats = {"loaded": 0, "skipped": 0, "not_retried": 0}
+                plan = await self.plan_catalog(
+                    self.iter_pending_movies(catalog_entries(), plan_stats),
+                    download_concurrency, upload_concurrency
+                )
+                self.log_plan(plan)
+                if plan_only:
+                    return
             
             # Start Pyrogram client
             await self.app.start()
             logger.info("Pyrogram client started")
             
-            # Process movies with limited concurrency
-            semaphore = asyncio.Semaphore(max_concurrent)
-            
-            async def process_with_semaphore(movie_data):
-                async with semaphore:
-                    return await self.process_movie(movie_data)
+            # Keep our leases alive while long transfers run
+            heartbeat = asyncio.create_task(self.heartbeat())
+            logger.info(f"Running as {self.runner_id} with {self.lease_seconds}s leases")
             
-            # Create tasks for all movies
-            tasks = [process_with_semaphore(movie) for movie in movies_data]
-            
-            # Process all movies
-            results = await asyncio.gather(*tasks, return_exceptions=True)
+            # Due retries go first, then entries streamed from the catalog file, all through the bounded work queue
+            retries = await self.run_db(self.load_due_retries)
+            if retries:
+                logger.info(f"Retrying {len(retries)} movies that failed earlier")
+            catalog_stats = {"loaded": 0, "skipped": 0, "not_retried": 0, "unchanged": 0}
+            if incremental_sync:
+                pending_movies = self.iter_catalog_changes(catalog_entries(), catalog_stats, json_source, validators)
+            else:
+                pending_movies = self.iter_pending_movies(catalog_entries(), catalog_stats)
+            work = self.iter_work(retries, pending_movies)
+            if self.time_budget:
+                work = self.iter_smallest_first(work)
+            results = await self.run_work_queue(work, download_concurrency, upload_concurrency)
             
-            # Count results
-            successful = sum(1 for result in results if result is True)
-            failed = len(results) - successful
+            logger.info(f"Loaded {catalog_stats['loaded']} movies from {json_file_path or 'the catalog snapshot'}, {catalog_stats['unchanged']} unchanged since the last sync")
+            logger.info(f"Processing completed: {results['successful']} successful, {results['failed']} failed, {results['not_started']} left to other runners or the next run, {catalog_stats['skipped']} already uploaded, {catalog_stats['not_retried']} failed for good or waiting to retry")
             
-            logger.info(f"Processing completed: {successful} successful, {failed} failed")
+        except Exception as e:
+            logger.error(f"Error processing movies: {str(e)}")
+        
+        finally:
+            if heartbeat:
+                heartbeat.cancel()
             
             # Clean up downloaded JSON file if it was from Google Drive
             if local_json_path and os.path.exists(local_json_path):
@@ -406,31 +2765,46 @@ class TelegramMovieUploader:
                 except Exception as e:
                     logger.warning(f"Could not clean up JSON file: {str(e)}")
             
-        except Exception as e:
-            logger.error(f"Error processing movies: {str(e)}")
-        
-        finally:
+            # Report how busy the connection pool got, then release it
+            pool_stats = self.get_pool_stats()
+            if pool_stats:
+                logger.info(f"HTTP pool stats: {pool_stats}")
+            if self.download_cache:
+                logger.info(
+                    f"Download cache: {self.download_cache.hits} hits, {self.download_cache.misses} misses, "
+                    f"{len(self.download_cache.entries)} files ({self.download_cache.size() / 1024 ** 3:.1f}GB) kept"
+                )
+            await self.close_http_session()
+            
             # Stop Pyrogram client
-            await self.app.stop()
-            logger.info("Pyrogram client stopped")
+            await self.part_uploader.stop()
+            if self.app.is_connected:
+                await self.app.stop()
+                logger.info("Pyrogram client stopped")
     
     def get_upload_stats(self):
         """Get upload statistics from database"""
         total = self.collection.count_documents({})
         uploaded = self.collection.count_documents({"status": "uploaded"})
         failed = self.collection.count_documents({"status": "failed"})
+        retrying = self.collection.count_documents({"status": "retrying"})
+        in_progress = self.collection.count_documents({"status": "in_progress"})
         split_files = self.collection.count_documents({"status": "uploaded", "is_split": True})
         
         return {
             "total": total,
             "uploaded": uploaded,
             "failed": failed,
-            "pending": total - uploaded - failed,
+            "retrying": retrying,
+            "in_progress": in_progress,
+            "pending": total - uploaded - failed - retrying - in_progress,
             "split_files": split_files
         }
     
     def close(self):
         """Close MongoDB connection"""
+        self.db_executor.shutdown(wait=True)
+        self.hash_executor.shutdown(wait=True)
         self.mongo_client.close()
 
 async def main():
@@ -442,13 +2816,50 @@ async def main():
     MONGODB_URI = os.getenv('MONGODB_URI', 'mongodb://localhost:27017/')
     GDRIVE_JSON_URL = os.getenv('GDRIVE_JSON_URL', 'https://drive.google.com/file/d/1VB9C9l38_PvxZAWs3fUtUw9bKKEavPBu/view?usp=sharing')
     MAX_CONCURRENT = int(os.getenv('MAX_CONCURRENT', '2'))
+    STREAM_UPLOADS = os.getenv('STREAM_UPLOADS', 'false').lower() in ('1', 'true', 'yes')
+    STREAM_BUFFER_PARTS = int(os.getenv('STREAM_BUFFER_PARTS', '8'))
+    DOWNLOAD_CONNECTIONS = int(os.getenv('DOWNLOAD_CONNECTIONS', '4'))
+    DOWNLOAD_SEGMENT_SIZE_MB = int(os.getenv('DOWNLOAD_SEGMENT_SIZE_MB', '64'))
+    HTTP_LIMIT = int(os.getenv('HTTP_LIMIT', '32'))
+    HTTP_LIMIT_PER_HOST = int(os.getenv('HTTP_LIMIT_PER_HOST', '8'))
+    HTTP_CONNECT_TIMEOUT = float(os.getenv('HTTP_CONNECT_TIMEOUT', '30'))
+    HTTP_READ_TIMEOUT = float(os.getenv('HTTP_READ_TIMEOUT', '120'))
+    HTTP_TOTAL_TIMEOUT = float(os.getenv('HTTP_TOTAL_TIMEOUT')) if os.getenv('HTTP_TOTAL_TIMEOUT') else None
+    DB_WORKERS = int(os.getenv('DB_WORKERS', '4'))
+    DISK_BUDGET_GB = float(os.getenv('DISK_BUDGET_GB')) if os.getenv('DISK_BUDGET_GB') else None
+    DISK_HEADROOM_MB = int(os.getenv('DISK_HEADROOM_MB', '1024'))
+    TELEGRAM_SENDS_PER_MINUTE = float(os.getenv('TELEGRAM_SENDS_PER_MINUTE', '20'))
+    PART_UPLOAD_CONCURRENCY = int(os.getenv('PART_UPLOAD_CONCURRENCY', '3'))
+    UPLOAD_CONNECTIONS = int(os.getenv('UPLOAD_CONNECTIONS', '2'))
+    UPLOAD_WORKERS = int(os.getenv('UPLOAD_WORKERS', '4'))
+    DOWNLOAD_CONCURRENCY = int(os.getenv('DOWNLOAD_CONCURRENCY', MAX_CONCURRENT))
+    UPLOAD_CONCURRENCY = int(os.getenv('UPLOAD_CONCURRENCY', MAX_CONCURRENT))
+    RETRY_MAX_ATTEMPTS = int(os.getenv('RETRY_MAX_ATTEMPTS', '5'))
+    RETRY_BASE_DELAY = int(os.getenv('RETRY_BASE_DELAY', '900'))
+    RUNNER_ID = os.getenv('RUNNER_ID')
+    LEASE_SECONDS = int(os.getenv('LEASE_SECONDS', '600'))
+    TIME_BUDGET_MINUTES = float(os.getenv('TIME_BUDGET_MINUTES')) if os.getenv('TIME_BUDGET_MINUTES') else None
+    PROBE_FIRST = os.getenv('PROBE_FIRST', 'false').lower() in ('1', 'true', 'yes')
+    PLAN_ONLY = os.getenv('PLAN_ONLY', 'false').lower() in ('1', 'true', 'yes')
+    PROBE_CACHE_TTL = int(os.getenv('PROBE_CACHE_TTL', '86400'))
+    DOWNLOAD_CACHE_GB = float(os.getenv('DOWNLOAD_CACHE_GB')) if os.getenv('DOWNLOAD_CACHE_GB') else None
+    INCREMENTAL_SYNC = os.getenv('INCREMENTAL_SYNC', 'true').lower() in ('1', 'true', 'yes')
+    STALL_MIN_RATE_KB = int(os.getenv('STALL_MIN_RATE_KB', '32'))
+    STALL_IDLE_TIMEOUT = int(os.getenv('STALL_IDLE_TIMEOUT', '60'))
+    WRITE_BUFFER_MB = int(os.getenv('WRITE_BUFFER_MB', '4'))
+    SMALL_FILE_MB = int(os.getenv('SMALL_FILE_MB', '32'))
+    MEMORY_BUDGET_MB = int(os.getenv('MEMORY_BUDGET_MB', '256'))
     
     # Validate required environment variables
     if not all([SESSION_STRING, API_ID, API_HASH, GROUP_ID]):
         logger.error("Missing required environment variables")
         return
     
-    logger.info(f"Starting with concurrent downloads: {MAX_CONCURRENT}")
+    logger.info(f"Starting with concurrent downloads: {DOWNLOAD_CONCURRENCY}, concurrent uploads: {UPLOAD_CONCURRENCY}")
+    if TIME_BUDGET_MINUTES:
+        logger.info(f"Time budget: {TIME_BUDGET_MINUTES:.0f} minutes")
+    if STREAM_UPLOADS:
+        logger.info(f"Streaming uploads enabled (buffer: {STREAM_BUFFER_PARTS} x 512KB parts)")
     
     # Create uploader instance
     uploader = TelegramMovieUploader(
@@ -456,20 +2867,56 @@ async def main():
         api_id=API_ID,
         api_hash=API_HASH,
         group_id=GROUP_ID,
-        mongodb_uri=MONGODB_URI
+        mongodb_uri=MONGODB_URI,
+        stream_uploads=STREAM_UPLOADS,
+        stream_buffer_parts=STREAM_BUFFER_PARTS,
+        download_connections=DOWNLOAD_CONNECTIONS,
+        download_segment_size_mb=DOWNLOAD_SEGMENT_SIZE_MB,
+        http_limit=HTTP_LIMIT,
+        http_limit_per_host=HTTP_LIMIT_PER_HOST,
+        http_connect_timeout=HTTP_CONNECT_TIMEOUT,
+        http_read_timeout=HTTP_READ_TIMEOUT,
+        http_total_timeout=HTTP_TOTAL_TIMEOUT,
+        db_workers=DB_WORKERS,
+        disk_budget_gb=DISK_BUDGET_GB,
+        disk_headroom_mb=DISK_HEADROOM_MB,
+        telegram_sends_per_minute=TELEGRAM_SENDS_PER_MINUTE,
+        part_upload_concurrency=PART_UPLOAD_CONCURRENCY,
+        upload_connections=UPLOAD_CONNECTIONS,
+        upload_workers=UPLOAD_WORKERS,
+        retry_max_attempts=RETRY_MAX_ATTEMPTS,
+        retry_base_delay=RETRY_BASE_DELAY,
+        runner_id=RUNNER_ID,
+        lease_seconds=LEASE_SECONDS,
+        probe_cache_ttl=PROBE_CACHE_TTL,
+        download_cache_gb=DOWNLOAD_CACHE_GB,
+        stall_min_rate_kb=STALL_MIN_RATE_KB,
+        stall_idle_timeout=STALL_IDLE_TIMEOUT,
+        write_buffer_mb=WRITE_BUFFER_MB,
+        memory_file_threshold_mb=SMALL_FILE_MB,
+        memory_budget_mb=MEMORY_BUDGET_MB
     )
     
     try:
         # Show current stats
-        stats = uploader.get_upload_stats()
-        logger.info(f"Current stats - Total: {stats['total']}, Uploaded: {stats['uploaded']}, Failed: {stats['failed']}, Pending: {stats['pending']}, Split files: {stats['split_files']}")
+        stats = await uploader.run_db(uploader.get_upload_stats)
+        logger.info(f"Current stats - Total: {stats['total']}, Uploaded: {stats['uploaded']}, Failed: {stats['failed']}, Retrying: {stats['retrying']}, In progress: {stats['in_progress']}, Pending: {stats['pending']}, Split files: {stats['split_files']}")
         
         # Process all movies using Google Drive URL
-        await uploader.process_all_movies(GDRIVE_JSON_URL, max_concurrent=MAX_CONCURRENT)
+        await uploader.process_all_movies(
+            GDRIVE_JSON_URL,
+            max_concurrent=MAX_CONCURRENT,
+            download_concurrency=DOWNLOAD_CONCURRENCY,
+            upload_concurrency=UPLOAD_CONCURRENCY,
+            time_budget=TIME_BUDGET_MINUTES * 60 if TIME_BUDGET_MINUTES else None,
+            probe_first=PROBE_FIRST,
+            plan_only=PLAN_ONLY,
+            incremental_sync=INCREMENTAL_SYNC
+        )
         
         # Show final stats
-        final_stats = uploader.get_upload_stats()
-        logger.info(f"Final stats - Total: {final_stats['total']}, Uploaded: {final_stats['uploaded']}, Failed: {final_stats['failed']}, Split files: {final_stats['split_files']}")
+        final_stats = await uploader.run_db(uploader.get_upload_stats)
+        logger.info(f"Final stats - Total: {final_stats['total']}, Uploaded: {final_stats['uploaded']}, Failed: {final_stats['failed']}, Retrying: {final_stats['retrying']}, Split files: {final_stats['split_files']}")
         
     finally:
         uploader.close()